@@ -1,8 +1,9 @@
 import numpy as np
-import pandas as pd
 from matplotlib import pyplot as plt
 from tqdm import tqdm
 
+from cl_ingest import CSVChunkReader
+
 class Human:
     def __init__(self, id, traj_obs):
 
@@ -33,7 +34,6 @@ class Human:
 
 if __name__ == "__main__":
 
-    header=["time","person_id", "x","y","z",'velocity', 'motion_angle',"facing_angle"]
     file_name = "C:\\Users\\79359\\Downloads\\atc-20121114.csv"
     chunksize = 10000
     fig0, ax0 = plt.subplots(1, 1) 
@@ -43,10 +43,7 @@ if __name__ == "__main__":
     x_max = 10000
     y_min = -12000
     y_max = 24000
-    for chunk in tqdm(pd.read_csv(file_name, chunksize=chunksize)):
-        chunk.columns=header
-        chunk = chunk.loc[chunk["x"]<x_max]
-        chunk = chunk.loc[chunk["y"]<y_max]
+    for chunk in tqdm(CSVChunkReader(file_name, chunksize=chunksize, bbox=(-np.inf, x_max, -np.inf, y_max))):
         human_id_observed = chunk["person_id"].unique()
         #print(human_id_observed)
 
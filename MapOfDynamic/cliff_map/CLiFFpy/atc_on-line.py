@@ -1,11 +1,13 @@
 import numpy as np
-import pandas as pd
-from matplotlib import pyplot as plt
 import argparse
+import os
 
 import helpers as he
+from cl_delta import CLDeltaWriter, cell_records
+from cl_ingest import CSVChunkReader
 from cl_map import CLCellType
 from cl_map import CLMap as cl
+from cl_map_visualisation import FrameWriter, density_image
 
 # line format
 # time [ms] (unixtime + milliseconds/1000), person id, position x [mm], position y [mm], position z (height) [mm], velocity [mm/s], angle of motion [rad], facing angle [rad]
@@ -14,7 +16,15 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser('Parse start goal condition')
     parser.add_argument('--start', type=int, default=4)
     parser.add_argument('--goal', type=int, default=2)
+    parser.add_argument('--checkpoint', type=str, default="checkpoint_{}_{}.npz")
+    parser.add_argument('--checkpoint_every', type=int, default=10)
+    # sliding window: half life of accumulated statistics in seconds, evict micro-cells below min_weight
+    parser.add_argument('--half_life', type=float, default=None)
+    parser.add_argument('--min_weight', type=float, default=0.05)
+    # refreshes append changed cells to mod_cliff_{start}_{goal}.log, the csv is rewritten every compact_every
+    parser.add_argument('--compact_every', type=int, default=10)
     args = parser.parse_args()
+    checkpoint_file = args.checkpoint.format(args.start, args.goal)
     file_name = "C:\\Users\\79359\\Downloads\\atc-20121114.csv"
     start_goal_data_with_labels = np.genfromtxt("start_goal_with_label.csv",
                                                 delimiter=",")
@@ -32,81 +42,60 @@ if __name__ == '__main__':
     y_min = -12
     y_max = 24
     step = 1.
-    p_shape = (round((y_max - y_min) / step), round((x_max - x_min) / step))
+
+    def cell_key(corner):
+        return int((corner[1] - y_min) / step), int((corner[0] - x_min) / step)
 
     cl_map = cl()
 
-    cl_map.set_up_map(step=step, processing=CLCellType.STREAM)
+    cl_map.set_up_map(step=step, processing=CLCellType.STREAM, half_life=args.half_life, min_weight=args.min_weight)
+
+    # resume from the last checkpoint: skip the rows already ingested
+    cursor = 0
+    if os.path.exists(checkpoint_file):
+        cursor, meta = cl_map.load_checkpoint(checkpoint_file)
+        loop_number = meta['loop_number']
+        print("resuming from row", cursor)
+    # the first refresh exports every cell, dropping cells a previous run left in the snapshot
+    full_export = True
+    mod_writer = CLDeltaWriter("mod_cliff_{}_{}.log".format(args.start, args.goal),
+                               "mod_cliff_{}_{}.csv".format(args.start, args.goal), compact_every=args.compact_every)
 
-    fig0, ax0 = plt.subplots(1, 1)  # ,sharex=True,sharey=True)
-    # fig1, ax1= plt.subplots(1, 1)#,sharex=True,sharey=True)
-    header=["time","person_id", "x","y","z",'velocity', 'motion_angle',"facing_angle"]
+    # frames are rendered on a background thread, observation density is binned per chunk
+    frame_writer = FrameWriter()
+    extent = (x_min, x_max, y_min, y_max)
+    density = np.zeros((round((y_max - y_min) / 0.1), round((x_max - x_min) / 0.1)), dtype=np.int64)
+    obstacle = np.array([[-30000.,-22000,-21500.,-7000.,-7000.,2000.,8500.,5000.],
+                         [900,500.,8500.,8500.,140.,0.,3300.,-1000.]])/1000.
 
-    for chunk in pd.read_csv(file_name, chunksize=chunksize):
-        chunk.columns=header
-        chunk = chunk.loc[chunk["person_id"].isin(target_ped_id_list)]
-        # filter by ped_id with specific start and goal
+    # filter by ped_id with specific start and goal while the next chunk is parsed in the background
+    reader = CSVChunkReader(file_name, chunksize=chunksize, skiprows=cursor, person_ids=target_ped_id_list)
+    for chunk in reader:
         cl_map.load_data(chunk)
+        density += density_image(chunk['x'].to_numpy(), chunk['y'].to_numpy(), extent, 0.1)
         loop_number = loop_number + 1
-        plot_data = []
-        mod_data = []
+        if loop_number % args.checkpoint_every == 0:
+            cl_map.save_checkpoint(checkpoint_file, cursor + reader.rows_read, loop_number=loop_number)
         if loop_number % refresh_ratio == 0:
-            ax0.clear()
-            ax0.set_aspect('equal')
-            ax0.set_xlim(x_min, x_max)
-            ax0.set_ylim(y_min, y_max)
-            cl_map.cluster_data()
+            # only cells whose micro-cells changed since the last refresh are clustered and exported
+            cl_map.cluster_data(only_changed=True)
+            changed, removed = cl_map.pop_changes()
+            seq = mod_writer.write({cell_key(cell.corner): cell_records(cell) for cell in changed},
+                                   [cell_key(corner) for corner in removed], replace=full_export)
+            full_export = False
+            print("delta:", seq, "changed:", len(changed), "removed:", len(removed))
 
-            p_array_vis = np.zeros(p_shape)
-            #plot_angle_grid = np.zeros(p_shape)
             # visualisation
-            for cell in cl_map.cells_data:
-                for m,cov,w in zip(cell.clustering_results.mean_values,
-                                 cell.clustering_results.covariances,
-                                 cell.clustering_results.mixing_factors):
-                    try:
-                        u, v = he.pol2cart(m[0], m[1])
-                        mod_data_row = [int((cell.corner[1] - y_min) / step), 
-                                        int((cell.corner[0] - x_min) / step), 
-                                        round(w,3),
-                                        round(m[0],3), 
-                                        round(m[1],3),
-                                        round(cov[0,0],3),
-                                        round(cov[0,1],3),
-                                        round(cov[1,0],3),
-                                        round(cov[1,1],3)]
-                        row = [cell.corner[0] + cl_map.grid_step / 2, 
-                               cell.corner[1] + cl_map.grid_step / 2, 
-                               u, 
-                               v]
-                        plot_data.append(row)
-                        mod_data.append(mod_data_row)
-                        p_array_vis[int((cell.corner[1] - y_min) / step), 
-                                    int((cell.corner[0] - x_min) / step)] = cell.count[0] / cl_map.total_number_of_observations
-                        # plot_angle_grid[int((cell.corner[1] - y_min) / step), 
-                        #             int((cell.corner[0] - x_min) / step)] = np.arctan2(v,u)*180./np.pi+180.
-                    except:
-                        pass
-                        #print(p_shape, int((cell.corner[1] - y_min) / step),int((cell.corner[0] - x_min) / step))
-            plot_data = np.array(plot_data)
-            if len(mod_data)>0:
-                mod_data = np.array(mod_data)
-                print("shape:",mod_data.shape)
-                # plot_angle_grid = np.where(p_array_vis>0,plot_angle_grid,-1)
-                np.savetxt("mod_cliff_{}_{}.csv".format(args.start,args.goal),
-                        mod_data,delimiter=",")
-                obstacle = np.array([[-30000.,-22000,-21500.,-7000.,-7000.,2000.,8500.,5000.],
-                            [900,500.,8500.,8500.,140.,0.,3300.,-1000.]])/1000.
-                ax0.quiver(plot_data[:, 0], plot_data[:, 1], plot_data[:, 2], plot_data[:, 3], units='xy')
-                ax0.scatter(obstacle[0],
-                            obstacle[1],marker="*",c="b")
-                ax0.set_title("Observations count: " + str(chunksize * loop_number))
-                plt.savefig("result/directions_{}_{}_".format(args.start,args.goal) + str(loop_number).zfill(5) + '.png', bbox_inches='tight')
-                # plt.show()
-
-            # ax0.clear()
-            # ax0.set_aspect('equal')
-            # ax0.set_title("Observations count: " + str(chunksize * loop_number))
-            # ax0.imshow(np.flipud(p_array_vis), cmap="plasma", vmin=0,vmax=np.max(np.max(p_array_vis)))
-            # plt.savefig("result/intensity_" + str(loop_number).zfill(5) + '.png', bbox_inches='tight')
-            # plt.show()
\ No newline at end of file
+            if len(mod_writer.state) > 0:
+                keys = list(mod_writer.state)
+                mod_data = np.concatenate([mod_writer.state[key] for key in keys])
+                cell_rows = np.repeat(np.array(keys, dtype=float), [len(mod_writer.state[key]) for key in keys], axis=0)
+                u, v = he.pol2cart(mod_data[:, 1], mod_data[:, 2])
+                plot_data = np.column_stack((x_min + (cell_rows[:, 1] + 0.5) * step,
+                                             y_min + (cell_rows[:, 0] + 0.5) * step, u, v))
+                frame_writer.write("result/directions_{}_{}_".format(args.start, args.goal) + str(loop_number).zfill(5) + '.png',
+                                   image=density.copy(), extent=extent, arrows=plot_data, markers=obstacle,
+                                   title="Observations count: " + str(chunksize * loop_number),
+                                   xlim=(x_min, x_max), ylim=(y_min, y_max))
+    frame_writer.close()
+    mod_writer.close()
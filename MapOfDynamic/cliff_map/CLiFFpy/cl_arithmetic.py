@@ -2,6 +2,9 @@ import numpy as np
 import math
 import collections
 
+# rows per tile in the blocked pairwise kernels, keeps temporaries at BLOCK_SIZE x BLOCK_SIZE
+BLOCK_SIZE = 1024
+
 
 def wrap_to_pi(a):
     if (a < -math.pi) or (a > math.pi):
@@ -11,11 +14,24 @@ def wrap_to_pi(a):
     return a
 
 
-def wrap_to_pi_vec(a):
-    res_1 = ((a + math.pi) % (2 * math.pi) - math.pi) * ((a < -math.pi) | (a > math.pi))
-    res_2 = a * ~((a < -math.pi) | (a > math.pi))
-    res = res_1+res_2
-    return res
+def _float_out(a, out):
+    if out is None:
+        return np.array(a, dtype=np.result_type(a, float))
+    if out is not a:
+        np.copyto(out, a)
+    return out
+
+
+def wrap_to_pi_vec(a, out=None):
+    # only the elements outside [-pi, pi] are rewritten, in place in out
+    a = np.asarray(a)
+    outside = np.less(a, -math.pi)
+    outside |= np.greater(a, math.pi)
+    out = _float_out(a, out)
+    np.add(out, math.pi, out=out, where=outside)
+    np.mod(out, 2 * math.pi, out=out, where=outside)
+    np.subtract(out, math.pi, out=out, where=outside)
+    return out if out.ndim else out[()]
 
 
 def wrap_to_2pi(a):
@@ -26,11 +42,14 @@ def wrap_to_2pi(a):
     return a
 
 
-def wrap_to_2pi_vec(a):
-    res_1 = (abs(a % (2 * math.pi))) * ((a < 0) | (a > 2 * math.pi))
-    res_2 = a * ~((a < 0) | (a > 2 * math.pi))
-    res = res_1+res_2
-    return res
+def wrap_to_2pi_vec(a, out=None):
+    a = np.asarray(a)
+    outside = np.less(a, 0)
+    outside |= np.greater(a, 2 * math.pi)
+    out = _float_out(a, out)
+    np.mod(out, 2 * math.pi, out=out, where=outside)
+    np.abs(out, out=out, where=outside)
+    return out if out.ndim else out[()]
 
 
 def distance_cos_2d(p1, p2):
@@ -51,45 +70,63 @@ def distance_wrap_2d(p1, p2):
     return dist
 
 
-def distance_wrap_2d_vec(p1, p2):
-    diff = np.subtract(p1, p2)
-    r = np.hsplit(diff, 2)
-    ar = r[0].flatten()
-    lr = r[1].flatten()
-    ad = abs(wrap_to_pi_vec(ar))
-    ld = abs(lr)
-    ad_ad = np.multiply(ad, ad)
-    ld_ld = np.multiply(ld, ld)
-    dist = np.sqrt(ad_ad + ld_ld)
-    return dist
-
-
-def distance_wrap_2d_vec_pair(p1, p2):
-
-    shape1 = np.shape(p1)[0]
-    shape2 = np.shape(p2)[0]
-    p2 = p2.flatten()
-
-    p1_rep = np.tile(p1, (1, shape2))
-    p2_rep = np.tile(p2, (shape1, 1))
-
-    diff = np.subtract(p1_rep, p2_rep)
-
-    columns = int(np.shape(diff)[1]/2)
-    diff_col = np.hsplit(diff, columns)
-    dist = np.empty((0, columns), float)
-    for c in range(0, columns):
-        r = np.hsplit(diff_col[c], 2)
-        ar = r[0].flatten()
-        lr = r[1].flatten()
-        ad = abs(wrap_to_pi_vec(ar))
-        ld = abs(lr)
-        ad_ad = np.multiply(ad, ad)
-        ld_ld = np.multiply(ld, ld)
-        d = np.array(np.sqrt(ad_ad + ld_ld))
-        d = d.reshape(1, columns)
-        dist = np.append(dist, d, axis=0)
-    return dist
+def _distance_wrap_2d_inplace(diff, out):
+    # diff is a (..., 2) scratch buffer of angular and linear differences and is overwritten
+    ad = wrap_to_pi_vec(diff[..., 0], out=out)
+    np.multiply(ad, ad, out=ad)
+    ld = diff[..., 1]
+    np.multiply(ld, ld, out=ld)
+    np.add(ad, ld, out=ad)
+    return np.sqrt(ad, out=ad)
+
+
+def distance_wrap_2d_vec(p1, p2, out=None):
+    diff = np.subtract(p1, p2).reshape(-1, 2)
+    if out is None:
+        out = np.empty(diff.shape[0], dtype=np.result_type(diff, float))
+    return _distance_wrap_2d_inplace(diff, out)
+
+
+def _pair_blocks(p1, p2, out, block_size, dtype):
+    # yields (tile of out, scratch buffer of differences), out[j, i] pairs p2[j] with p1[i]
+    p1 = np.asarray(p1, dtype=dtype).reshape(-1, 2)
+    p2 = np.asarray(p2, dtype=dtype).reshape(-1, 2)
+    buffer = np.empty((min(block_size, p2.shape[0]) * min(block_size, p1.shape[0]) * 2,), dtype=dtype)
+    for j in range(0, p2.shape[0], block_size):
+        b2 = p2[j:j + block_size]
+        for i in range(0, p1.shape[0], block_size):
+            b1 = p1[i:i + block_size]
+            diff = buffer[:b2.shape[0] * b1.shape[0] * 2].reshape(b2.shape[0], b1.shape[0], 2)
+            np.subtract(b1[None, :, :], b2[:, None, :], out=diff)
+            yield out[j:j + block_size, i:i + block_size], diff
+
+
+def distance_wrap_2d_vec_pair(p1, p2, out=None, block_size=BLOCK_SIZE, dtype=float):
+    # out[j, i] is the wrapped distance between p1[i] and p2[j], shape (len(p2), len(p1))
+    if out is None:
+        out = np.empty((np.shape(p2)[0], np.shape(p1)[0]), dtype=dtype)
+    for tile, diff in _pair_blocks(p1, p2, out, block_size, dtype):
+        _distance_wrap_2d_inplace(diff, tile)
+    return out
+
+
+def gaussian_weights_vec(distance, bandwidth, out=None):
+    # same arithmetic as utils.gaussian_kernel, evaluated in place
+    out = _float_out(np.asarray(distance), out)
+    np.divide(out, bandwidth, out=out)
+    np.multiply(out, out, out=out)
+    np.multiply(out, -0.5, out=out)
+    np.exp(out, out=out)
+    np.multiply(out, 1 / (bandwidth * math.sqrt(2 * math.pi)), out=out)
+    return out
+
+
+def gaussian_weights_pair(p1, p2, bandwidth, out=None, block_size=BLOCK_SIZE, dtype=float):
+    if out is None:
+        out = np.empty((np.shape(p2)[0], np.shape(p1)[0]), dtype=dtype)
+    for tile, diff in _pair_blocks(p1, p2, out, block_size, dtype):
+        gaussian_weights_vec(_distance_wrap_2d_inplace(diff, tile), bandwidth, out=tile)
+    return out
 
 
 def distance_disjoint_2d(p1, p2):
@@ -103,14 +140,36 @@ def distance_disjoint_2d(p1, p2):
 def weighted_mean_2d_vec(p, w):
     a = p[:, 0]
     le = p[:, 1]
+    w_sum = np.sum(w)
 
-    c = np.sum(np.multiply(np.cos(a), w)) / np.sum(w)
-    s = np.sum(np.multiply(np.sin(a), w)) / np.sum(w)
+    buffer = np.cos(a)
+    c = np.sum(np.multiply(buffer, w, out=buffer)) / w_sum
+    np.sin(a, out=buffer)
+    s = np.sum(np.multiply(buffer, w, out=buffer)) / w_sum
 
     if c >= 0:
         cr_m = np.arctan(s/c)
     else:
         cr_m = np.arctan(s/c)+math.pi
-    l_m = np.sum(np.multiply(le, w)) / np.sum(w)
+    l_m = np.sum(np.multiply(le, w, out=buffer)) / w_sum
     mean = [wrap_to_2pi(cr_m), l_m]
     return mean
+
+
+def weighted_mean_2d_pair(p, w, out=None):
+    # circular weighted means of p for every row of the (m, n) weight matrix w, shape (m, 2)
+    p = np.asarray(p)
+    w = np.asarray(w)
+    if out is None:
+        out = np.empty((w.shape[0], 2), dtype=np.result_type(p, w, float))
+    w_sum = np.sum(w, axis=1)
+    c = w @ np.cos(p[:, 0])
+    s = w @ np.sin(p[:, 0])
+    np.divide(c, w_sum, out=c)
+    np.divide(s, w_sum, out=s)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.arctan(np.divide(s, c, out=s), out=out[:, 0])
+    np.add(out[:, 0], math.pi, out=out[:, 0], where=c < 0)
+    wrap_to_2pi_vec(out[:, 0], out=out[:, 0])
+    np.divide(w @ p[:, 1], w_sum, out=out[:, 1])
+    return out
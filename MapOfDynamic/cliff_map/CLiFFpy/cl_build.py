@@ -0,0 +1,250 @@
+import argparse
+import glob
+import hashlib
+import multiprocessing as mp
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+from cl_ingest import CSVChunkReader
+from cl_map import CLCell, CLCellShape, CLCellType, CLMap, cluster_worker, run_starts
+from utils import atomic_write
+
+
+# map phase: every input file is reduced to per-cell micro-cell sums and counts (the same binned
+# points a STREAM cell accumulates), stored as <partial_dir>/<file stem>_<digest>.npz. The digest covers
+# the map parameters and the file size/mtime, so adding a new day only computes the partial of that day.
+
+def partial_path(partial_dir, file_name, params):
+    stat = os.stat(file_name)
+    key = repr((os.path.abspath(file_name), stat.st_size, stat.st_mtime, sorted(params.items(), key=str)))
+    digest = hashlib.md5(key.encode()).hexdigest()[:12]
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    return os.path.join(partial_dir, "{}_{}.npz".format(stem, digest))
+
+
+def empty_partial():
+    return {'keys': np.empty((0, 4)), 'sums': np.empty((0, 2)), 'count': np.empty(0, dtype=np.int64),
+            'times': np.empty(0), 'extent': np.array([np.inf, -np.inf, np.inf, -np.inf])}
+
+
+def merge_partials(partials):
+    keys = np.concatenate([p['keys'] for p in partials])
+    sums = np.concatenate([p['sums'] for p in partials])
+    count = np.concatenate([p['count'] for p in partials])
+    extents = np.array([p['extent'] for p in partials])
+    merged = {'times': np.unique(np.concatenate([p['times'] for p in partials])),
+              'extent': np.array([extents[:, 0].min(), extents[:, 1].max(), extents[:, 2].min(), extents[:, 3].max()])}
+    # rows are (cell corner x, cell corner y, micro-cell velocity, micro-cell angle)
+    unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    merged['keys'] = unique_keys
+    merged['sums'] = np.stack([np.bincount(inverse, weights=sums[:, i], minlength=len(unique_keys))
+                               for i in range(2)], axis=1)
+    merged['count'] = np.bincount(inverse, weights=count, minlength=len(unique_keys)).astype(np.int64)
+    return merged
+
+
+def compute_partial(cl_map, micro_cell, data):
+    # data is in metres and m/s, as CLMap.load_data converts it
+    partial = empty_partial()
+    if len(data) == 0:
+        return partial
+    xy = data[['x', 'y']].to_numpy()
+    corners, members = cl_map.get_cell_members(xy)
+    rows = np.concatenate(members)
+    cell_corners = np.repeat(np.array(corners), [len(m) for m in members], axis=0)
+    values = data[['velocity', 'motion_angle']].to_numpy()[rows]
+    centers = CLCell(None, None, cl_map.clustering_type, cl_map.grid_type, micro_cell=micro_cell) \
+        .get_cell_centers_vec(values)
+    partial['keys'] = np.concatenate([cell_corners, centers], axis=1)
+    partial['sums'] = values
+    partial['count'] = np.ones(len(rows), dtype=np.int64)
+    partial['times'] = np.unique(data['time'].to_numpy())
+    partial['extent'] = np.array([xy[:, 0].min(), xy[:, 0].max(), xy[:, 1].min(), xy[:, 1].max()])
+    return merge_partials([partial])
+
+
+def partial_worker(args):
+    file_name, path, params, chunksize = args
+    cl_map = CLMap(pool_num=1)
+    cl_map.set_up_map(step=params['step'], radius=params['radius'], type=params['type'],
+                      processing=CLCellType.STREAM)
+    partial = empty_partial()
+    for chunk in CSVChunkReader(file_name, chunksize=chunksize, units=1000., person_ids=params['person_ids']):
+        partial = merge_partials([partial, compute_partial(cl_map, params['micro_cell'], chunk)])
+    # an interrupted worker never leaves a truncated partial
+    with atomic_write(path) as f:
+        np.savez(f, **partial)
+    return path
+
+
+def load_partial(path):
+    with np.load(path) as f:
+        return {k: f[k] for k in f.files}
+
+
+def build_map(file_names, partial_dir, pool_num=-1, chunksize=500 ** 2, person_ids=None, **kwargs):
+    cl_map = CLMap(pool_num)
+    cl_map.set_up_map(processing=CLCellType.STREAM, **kwargs)
+    params = {'step': cl_map.grid_step, 'radius': cl_map.grid_radius, 'type': cl_map.grid_type,
+              'micro_cell': cl_map.micro_cell,
+              'person_ids': None if person_ids is None else sorted(set(person_ids))}
+    os.makedirs(partial_dir, exist_ok=True)
+    paths = [partial_path(partial_dir, f, params) for f in file_names]
+
+    # map
+    todo = [(f, p, params, chunksize) for f, p in zip(file_names, paths) if not os.path.exists(p)]
+    if len(todo) > 0:
+        with mp.Pool(min(cl_map.pool_num, len(todo))) as p:
+            list(tqdm(p.imap_unordered(partial_worker, todo), total=len(todo)))
+
+    # reduce
+    merged = merge_partials([load_partial(p) for p in paths])
+    if len(merged['keys']) == 0:
+        return cl_map
+    cl_map.total_number_of_observations = len(merged['times'])
+    cl_map.set_data_extent(merged['extent'])
+    cl_map.initial = False
+    keys = merged['keys']
+    starts = run_starts(keys[:, :2])
+    ends = np.append(starts[1:], len(keys))
+    for start, end in zip(starts, ends):
+        cell = CLCell((keys[start, 0], keys[start, 1]), [], cl_map.clustering_type, cl_map.grid_type,
+                      cl_map.kernel_bandwidth, CLCellType.STREAM, cl_map.micro_cell)
+        cell.corners = [(k[2], k[3]) for k in keys[start:end]]
+        cell.sums = list(merged['sums'][start:end])
+        cell.count = merged['count'][start:end].tolist()
+        cl_map.cells_data.append(cell)
+    return cl_map
+
+
+# out-of-core BATCH: the input is streamed once and every (cell, velocity, motion_angle) row is
+# appended to one of a fixed number of on-disk partitions chosen by a hash of the cell. Partitions
+# are then loaded and clustered one at a time, so resident memory is bounded by the largest
+# partition instead of the dataset. Rows keep the input order within a cell, which makes the
+# clustering identical to CLMap.load_data in BATCH mode.
+
+def spill_path(spill_dir, partition):
+    return os.path.join(spill_dir, "part_{:04d}.bin".format(partition))
+
+
+def spill_partitions(cl_map, file_names, spill_dir, partitions, chunksize, person_ids=None):
+    offset = np.round(cl_map.grid_step / 2, decimals=0)
+    # unique timestamps per chunk, merged per file and once more at the end: merging into one growing
+    # set on every chunk would re-sort all timestamps seen so far each time
+    times = []
+    extent = np.array([np.inf, -np.inf, np.inf, -np.inf])
+    os.makedirs(spill_dir, exist_ok=True)
+    files = [open(spill_path(spill_dir, i), 'wb') for i in range(partitions)]
+    try:
+        for file_name in file_names:
+            file_times = []
+            # same conversion as CLMap.load_data
+            for chunk in CSVChunkReader(file_name, chunksize=chunksize, units=1000., person_ids=person_ids):
+                if len(chunk) == 0:
+                    continue
+                xy = chunk[['x', 'y']].to_numpy(dtype=float)
+                values = chunk[['velocity', 'motion_angle']].to_numpy(dtype=float)
+                file_times.append(np.unique(chunk['time'].to_numpy()))
+                extent = np.array([min(extent[0], xy[:, 0].min()), max(extent[1], xy[:, 0].max()),
+                                   min(extent[2], xy[:, 1].min()), max(extent[3], xy[:, 1].max())])
+                corners, members, starts = cl_map.get_cell_partition(xy)
+                lengths = np.diff(np.append(starts, len(members)))
+                rows = np.concatenate([np.repeat(np.array(corners), lengths, axis=0), values[members]], axis=1)
+                keys = np.round((rows[:, :2] + offset) / cl_map.grid_step).astype(np.int64)
+                partition = (keys[:, 0] * 73856093 ^ keys[:, 1] * 19349663) % partitions
+                order = np.argsort(partition, kind='stable')
+                bounds = np.searchsorted(partition[order], np.arange(partitions + 1))
+                for i in range(partitions):
+                    if bounds[i + 1] > bounds[i]:
+                        rows[order[bounds[i]:bounds[i + 1]]].tofile(files[i])
+            if len(file_times) > 0:
+                times.append(np.unique(np.concatenate(file_times)))
+    finally:
+        for f in files:
+            f.close()
+    return np.unique(np.concatenate(times)) if len(times) > 0 else np.empty(0), extent
+
+
+def remove_spill(spill_dir, partitions):
+    for i in range(partitions):
+        if os.path.exists(spill_path(spill_dir, i)):
+            os.remove(spill_path(spill_dir, i))
+    if len(os.listdir(spill_dir)) == 0:
+        os.rmdir(spill_dir)
+
+
+def cluster_worker_compact(obj):
+    obj = cluster_worker(obj)
+    # drop the per-point fields of the result, only the mixture parameters are kept
+    if obj.clustering_results is not None:
+        obj.clustering_results.original_points = None
+        obj.clustering_results.shifted_points = None
+        obj.clustering_results.cluster_ids = None
+        obj.clustering_results.history = None
+    return obj
+
+
+def build_out_of_core(file_names, spill_dir, partitions=64, pool_num=-1, chunksize=500 ** 2, person_ids=None,
+                      keep_points=False, keep_spill=False, **kwargs):
+    # the partitions are removed once clustered, unless keep_spill
+    cl_map = CLMap(pool_num)
+    cl_map.set_up_map(processing=CLCellType.BATCH, keep_data=False, **kwargs)
+    try:
+        times, extent = spill_partitions(cl_map, file_names, spill_dir, partitions, chunksize, person_ids)
+        if len(times) == 0:
+            return cl_map
+        cl_map.total_number_of_observations = len(times)
+        cl_map.set_data_extent(extent)
+
+        worker = cluster_worker if keep_points else cluster_worker_compact
+        with mp.Pool(cl_map.pool_num) as p:
+            for i in tqdm(range(partitions)):
+                rows = np.fromfile(spill_path(spill_dir, i)).reshape(-1, 4)
+                if len(rows) == 0:
+                    continue
+                # stable, so rows keep the input order within every cell
+                rows = rows[np.lexsort((rows[:, 1], rows[:, 0]))]
+                starts = run_starts(rows[:, :2])
+                ends = np.append(starts[1:], len(rows))
+                cells = []
+                for start, end in zip(starts, ends):
+                    cell = CLCell((rows[start, 0], rows[start, 1]), None, cl_map.clustering_type, cl_map.grid_type,
+                                  cl_map.kernel_bandwidth, length=end - start)
+                    cell.points = rows[start:end, 2:]
+                    cells.append(cell)
+                cl_map.cells_data.extend(p.imap(worker, cells))
+        cl_map.cells_data.sort(key=lambda cell: cell.corner)
+        return cl_map
+    finally:
+        if not keep_spill and os.path.isdir(spill_dir):
+            remove_spill(spill_dir, partitions)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Build a CLiFF map from many ATC day files')
+    parser.add_argument('--files', type=str, default="atc-*.csv")
+    parser.add_argument('--partial_dir', type=str, default="partials")
+    parser.add_argument('--step', type=float, default=1.)
+    parser.add_argument('--radius', type=float, default=1.)
+    parser.add_argument('--circular', action='store_true')
+    parser.add_argument('--micro_cell', type=float, default=0.1)
+    # out-of-core BATCH clustering of all points instead of merged micro-cells
+    parser.add_argument('--out_of_core', action='store_true')
+    parser.add_argument('--spill_dir', type=str, default="spill")
+    parser.add_argument('--partitions', type=int, default=64)
+    parser.add_argument('--keep_spill', action='store_true')
+    args = parser.parse_args()
+
+    file_names = sorted(glob.glob(args.files))
+    shape = CLCellShape.CIRCULAR if args.circular else CLCellShape.SQUARE
+    if args.out_of_core:
+        cl_map = build_out_of_core(file_names, args.spill_dir, args.partitions, keep_spill=args.keep_spill,
+                                   step=args.step, radius=args.radius, type=shape)
+    else:
+        cl_map = build_map(file_names, args.partial_dir, step=args.step, radius=args.radius, type=shape,
+                           micro_cell=args.micro_cell)
+        cl_map.cluster_data()
+    print("cells:", len(cl_map.cells_data), "observations:", cl_map.total_number_of_observations)
@@ -0,0 +1,204 @@
+# Incremental export of a streaming CLiFF map. Every refresh appends the records of the cells that
+# changed since the previous one to a binary log, and compaction folds the log into a snapshot in the
+# mod_cliff csv format (row, col, w, m0, m1, c00, c01, c10, c11 per component), so consumers of the
+# csv keep working while tailing readers apply the deltas on top of it:
+#
+#   writer = CLDeltaWriter("mod_cliff.log", "mod_cliff.csv")
+#   changed, removed = cl_map.pop_changes()
+#   writer.write({key(cell): cell_records(cell) for cell in changed}, [key(c) for c in removed])
+#
+#   reader = CLDeltaReader("mod_cliff.log", "mod_cliff.csv")
+#   keys = reader.poll()    # cells changed since the last poll, reader.state holds the current map
+#
+# A log record is RECORD_WIDTH little-endian float64 values: seq, row, col, w, m0, m1, c00, c01, c10,
+# c11. The records of a cell in one delta replace all its previous components, a record with a NaN
+# weight removes the cell. A marker record (seq, NaN, ...) closes every delta, and the first record of
+# a log is the marker of the sequence number the snapshot was compacted at. Readers only apply deltas
+# up to the last marker, so a delta that is still being written is never half applied.
+import os
+
+import numpy as np
+
+from utils import atomic_write
+
+RECORD_WIDTH = 10
+RECORD_DTYPE = np.dtype('<f8')
+RECORD_BYTES = RECORD_WIDTH * RECORD_DTYPE.itemsize
+
+
+def cell_records(cell, precision=3):
+    # (K, 7) records of w, m0, m1, c00, c01, c10, c11 for the K components of a clustered cell
+    result = cell.clustering_results
+    if result is None or len(result.mixing_factors) == 0:
+        return np.empty((0, RECORD_WIDTH - 3))
+    k = len(result.mixing_factors)
+    records = np.column_stack((np.reshape(result.mixing_factors, (k, 1)), np.reshape(result.mean_values, (k, 2)),
+                               np.reshape(result.covariances, (k, 4))))
+    return np.round(records, precision)
+
+
+def marker(seq):
+    record = np.full((1, RECORD_WIDTH), np.nan)
+    record[0, 0] = seq
+    return record
+
+
+def apply_records(state, records):
+    # applies complete deltas to state, a dict of (row, col) to (K, 7) records; returns the keys touched
+    keys = records[:, :3]
+    starts = np.flatnonzero(np.concatenate(([True], np.any(keys[1:] != keys[:-1], axis=1))))
+    ends = np.append(starts[1:], len(records))
+    touched = set()
+    for start, end in zip(starts, ends):
+        if np.isnan(records[start, 1]):
+            continue
+        key = (int(records[start, 1]), int(records[start, 2]))
+        if np.isnan(records[start, 3]):
+            state.pop(key, None)
+        else:
+            state[key] = records[start:end, 3:]
+        touched.add(key)
+    return touched
+
+
+def read_snapshot(path):
+    state = {}
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return state
+    rows = np.loadtxt(path, delimiter=",", ndmin=2)
+    seq = np.zeros((len(rows), 1))
+    apply_records(state, np.hstack((seq, rows)))
+    return state
+
+
+def write_snapshot(path, state):
+    keys = sorted(state)
+    rows = [np.column_stack((np.tile(key, (len(state[key]), 1)), state[key])) for key in keys]
+    rows = np.concatenate(rows) if len(rows) > 0 else np.empty((0, RECORD_WIDTH - 1))
+    with atomic_write(path) as f:
+        np.savetxt(f, rows, delimiter=",")
+
+
+class CLDeltaReader:
+    def __init__(self, log_path, snapshot_path):
+        self.log_path = log_path
+        self.snapshot_path = snapshot_path
+        self.state = {}
+        self.seq = 0
+        self.base = None
+        self.offset = 0
+        self.reload()
+
+    def read_base(self):
+        # sequence number in the marker a log starts with, None while there is no log
+        try:
+            with open(self.log_path, 'rb') as f:
+                head = f.read(RECORD_BYTES)
+        except FileNotFoundError:
+            return None
+        if len(head) < RECORD_BYTES:
+            return None
+        return np.frombuffer(head, dtype=RECORD_DTYPE)[0]
+
+    def reload(self):
+        # the writer replaces the snapshot before the log, so a snapshot read while the log base stays the
+        # same is at least as new as that log. A snapshot newer than the log is harmless: the log then holds
+        # deltas the snapshot already contains, and applying them again gives the same state.
+        old_keys = set(self.state)
+        base = self.read_base()
+        while True:
+            state = read_snapshot(self.snapshot_path)
+            again = self.read_base()
+            if again == base:
+                break
+            base = again
+        self.state = state
+        self.base = base
+        self.offset = 0
+        self.seq = 0 if base is None else int(base)
+        if base is not None:
+            self.poll()
+        return old_keys | set(self.state)
+
+    def poll(self):
+        # applies the deltas appended since the last poll, returns the keys of the cells they touched
+        try:
+            with open(self.log_path, 'rb') as f:
+                head = f.read(RECORD_BYTES)
+                if len(head) < RECORD_BYTES:
+                    return set()
+                base = np.frombuffer(head, dtype=RECORD_DTYPE)[0]
+                size = f.seek(0, os.SEEK_END)
+                if base != self.base or size < self.offset:
+                    # the log was compacted, or created, since the snapshot was read
+                    return self.reload()
+                f.seek(self.offset)
+                data = f.read((size - self.offset) // RECORD_BYTES * RECORD_BYTES)
+        except FileNotFoundError:
+            return set()
+        records = np.frombuffer(data, dtype=RECORD_DTYPE).reshape(-1, RECORD_WIDTH)
+        markers = np.flatnonzero(np.isnan(records[:, 1]) & np.isnan(records[:, 3]))
+        if len(markers) == 0:
+            return set()
+        records = records[:markers[-1] + 1]
+        self.offset += len(records) * RECORD_BYTES
+        self.seq = int(records[-1, 0])
+        return apply_records(self.state, records)
+
+
+class CLDeltaWriter:
+    def __init__(self, log_path, snapshot_path, compact_every=10):
+        self.log_path = log_path
+        self.snapshot_path = snapshot_path
+        self.compact_every = compact_every
+        # continue from what a previous run left behind
+        reader = CLDeltaReader(log_path, snapshot_path)
+        self.state = reader.state
+        self.seq = reader.seq
+        self.deltas = 0
+        self.log = None
+        self.compact()
+
+    def write(self, changes, removed=(), replace=False):
+        # changes maps (row, col) to the (K, 7) records of a cell and removed lists cells to drop; with
+        # replace, changes is the whole map and every other cell is dropped. Returns the sequence number.
+        removed = set(removed) - set(changes)
+        if replace:
+            removed |= set(self.state) - set(changes)
+        self.seq += 1
+        blocks = []
+        for key, records in changes.items():
+            if len(records) == 0:
+                removed.add(key)
+                continue
+            block = np.empty((len(records), RECORD_WIDTH))
+            block[:, 0] = self.seq
+            block[:, 1:3] = key
+            block[:, 3:] = records
+            blocks.append(block)
+            self.state[key] = block[:, 3:]
+        for key in removed:
+            if self.state.pop(key, None) is not None:
+                block = marker(self.seq)
+                block[0, 1:3] = key
+                blocks.append(block)
+        blocks.append(marker(self.seq))
+        self.log.write(np.concatenate(blocks).astype(RECORD_DTYPE).tobytes())
+        self.log.flush()
+        self.deltas += 1
+        if self.compact_every is not None and self.deltas >= self.compact_every:
+            self.compact()
+        return self.seq
+
+    def compact(self):
+        # the snapshot is replaced before the log, so a reader never misses a delta
+        write_snapshot(self.snapshot_path, self.state)
+        if self.log is not None:
+            self.log.close()
+        with atomic_write(self.log_path) as f:
+            f.write(marker(self.seq).astype(RECORD_DTYPE).tobytes())
+        self.log = open(self.log_path, 'ab')
+        self.deltas = 0
+
+    def close(self):
+        self.log.close()
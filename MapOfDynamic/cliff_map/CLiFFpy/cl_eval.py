@@ -0,0 +1,96 @@
+import argparse
+import itertools
+import multiprocessing as mp
+import time
+
+import numpy as np
+import pandas as pd
+
+from cl_ingest import ATC_HEADER, prepare_chunk
+from cl_map import CLCellShape, CLCellType, CLMap
+
+
+def split_observations(data, test_fraction=0.2, seed=0):
+    # held-out split by person, so no trajectory contributes to both the map and its evaluation
+    person_ids = data["person_id"].unique()
+    rng = np.random.default_rng(seed)
+    test_ids = rng.choice(person_ids, int(round(len(person_ids) * test_fraction)), replace=False)
+    is_test = data["person_id"].isin(test_ids)
+    return data.loc[~is_test], data.loc[is_test]
+
+
+def evaluate(mod, test):
+    # test holds raw ATC rows (mm, mm/s), converted as CSVChunkReader(units=1000.) does
+    test = prepare_chunk(test, units=1000.)
+    log_p = mod.log_likelihood(test['x'].to_numpy(), test['y'].to_numpy(), test['motion_angle'].to_numpy(dtype=float),
+                               test['velocity'].to_numpy())
+    covered = ~np.isnan(log_p)
+    return {'log_likelihood': float(np.mean(log_p[covered])) if covered.any() else -np.inf,
+            'empty_fraction': float(1 - np.mean(covered)) if len(log_p) > 0 else 0.}
+
+
+def build_and_evaluate(args):
+    train, test, params = args
+    start = time.perf_counter()
+    # one process per trial, trials run in parallel rather than the cells of one trial
+    cl_map = CLMap(pool_num=1)
+    cl_map.set_up_map(**params)
+    cl_map.load_data(train.copy())
+    cl_map.cluster_data()
+    mod = cl_map.get_mod()
+    build_time = time.perf_counter() - start
+    result = {'params': params, 'build_time': build_time, 'cells': len(mod.corners)}
+    result.update(evaluate(mod, test))
+    return result
+
+
+# train and test of the running sweep, handed to every worker once by init_sweep_worker
+sweep_data = {}
+
+
+def init_sweep_worker(train, test):
+    sweep_data['train'] = train
+    sweep_data['test'] = test
+
+
+def sweep_worker(params):
+    return build_and_evaluate((sweep_data['train'], sweep_data['test'], params))
+
+
+def sweep(train, test, param_grid, pool_num=-1):
+    # param_grid maps set_up_map keywords to lists of values, every combination is one trial
+    names = list(param_grid)
+    trials = [dict(zip(names, values)) for values in itertools.product(*(param_grid[n] for n in names))]
+    with mp.Pool(mp.cpu_count() if pool_num == -1 else pool_num, initializer=init_sweep_worker,
+                 initargs=(train, test)) as p:
+        return p.map(sweep_worker, trials)
+
+
+def pareto_front(results, quality='log_likelihood', cost='build_time'):
+    # results no other result beats on both higher quality and lower cost, cheapest first
+    front = []
+    for r in sorted(results, key=lambda r: (r[cost], -r[quality])):
+        if len(front) == 0 or r[quality] > front[-1][quality]:
+            front.append(r)
+    return front
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Sweep map parameters and report the quality/cost Pareto front')
+    parser.add_argument('--file', type=str, default="C:\\Users\\79359\\Downloads\\atc-20121114.csv")
+    parser.add_argument('--every', type=int, default=500)
+    parser.add_argument('--test_fraction', type=float, default=0.2)
+    parser.add_argument('--steps', type=float, nargs='+', default=[0.5, 1., 2.])
+    parser.add_argument('--bandwidths', type=float, nargs='+', default=[0.25, 0.5, 1.])
+    parser.add_argument('--micro_cells', type=float, nargs='+', default=[0.05, 0.1, 0.2])
+    args = parser.parse_args()
+
+    data = pd.read_csv(args.file, header=None, names=ATC_HEADER, skiprows=lambda x: x % args.every != 0)
+    train, test = split_observations(data, args.test_fraction)
+    grid = {'step': args.steps, 'kernel_bandwidth': args.bandwidths, 'micro_cell': args.micro_cells,
+            'processing': [CLCellType.STREAM], 'type': [CLCellShape.SQUARE]}
+    results = sweep(train, test, grid)
+    for r in pareto_front(results):
+        print("{:8.2f}s {:9.3f} empty {:5.3f} cells {:6d}".format(r['build_time'], r['log_likelihood'],
+                                                                 r['empty_fraction'], r['cells']),
+              {k: v for k, v in r['params'].items() if k in ('step', 'kernel_bandwidth', 'micro_cell')})
@@ -0,0 +1,107 @@
+import multiprocessing as mp
+import queue
+import threading
+
+import pandas as pd
+
+# line format
+# time [ms] (unixtime + milliseconds/1000), person id, position x [mm], position y [mm], position z (height) [mm], velocity [mm/s], angle of motion [rad], facing angle [rad]
+ATC_HEADER = ["time", "person_id", "x", "y", "z", 'velocity', 'motion_angle', "facing_angle"]
+
+
+def prepare_chunk(chunk, units=None, person_ids=None, bbox=None):
+    # person_ids and bbox are pushed down into the parser stage, bbox is (x_min, x_max, y_min, y_max)
+    # in the output units and keeps x_min <= x < x_max, y_min <= y < y_max
+    if person_ids is not None:
+        chunk = chunk.loc[chunk["person_id"].isin(person_ids)]
+    if units is not None:
+        chunk = chunk.copy()
+        for column in ('x', 'y', 'z', 'velocity'):
+            chunk[column] = chunk[column] / units
+    if bbox is not None:
+        chunk = chunk.loc[(chunk['x'] >= bbox[0]) & (chunk['x'] < bbox[1]) &
+                          (chunk['y'] >= bbox[2]) & (chunk['y'] < bbox[3])]
+    return chunk
+
+
+def put_or_stop(out_queue, stop, item):
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def produce_chunks(out_queue, stop, file_name, read_kwargs, filters):
+    try:
+        for chunk in pd.read_csv(file_name, **read_kwargs):
+            if not put_or_stop(out_queue, stop, (len(chunk), prepare_chunk(chunk, **filters))):
+                return
+    except Exception as e:
+        put_or_stop(out_queue, stop, e)
+    put_or_stop(out_queue, stop, None)
+
+
+class CSVChunkReader:
+    # parses, renames, converts and filters chunks in a background thread (or process) while the
+    # consumer works on the previous ones; at most queue_size parsed chunks wait in memory
+    def __init__(self, file_name, chunksize=500 ** 2, header=ATC_HEADER, skiprows=None, units=None,
+                 person_ids=None, bbox=None, queue_size=2, use_process=False):
+        self.file_name = file_name
+        self.read_kwargs = {'chunksize': chunksize, 'header': None, 'names': header, 'skiprows': skiprows}
+        self.filters = {'units': units, 'person_ids': None if person_ids is None else set(person_ids),
+                        'bbox': bbox}
+        self.queue_size = queue_size
+        self.use_process = use_process
+        # seconds between checks that the producer is still alive while waiting for a chunk
+        self.poll_interval = 0.5
+        self.rows_read = 0
+        self.worker = None
+        self.stop = None
+
+    def __iter__(self):
+        self.rows_read = 0
+        if self.use_process:
+            out_queue = mp.Queue(self.queue_size)
+            self.stop = mp.Event()
+            self.worker = mp.Process(target=produce_chunks, daemon=True,
+                                     args=(out_queue, self.stop, self.file_name, self.read_kwargs, self.filters))
+        else:
+            out_queue = queue.Queue(self.queue_size)
+            self.stop = threading.Event()
+            self.worker = threading.Thread(target=produce_chunks, daemon=True,
+                                           args=(out_queue, self.stop, self.file_name, self.read_kwargs, self.filters))
+        self.worker.start()
+        try:
+            while True:
+                try:
+                    item = out_queue.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    if self.worker.is_alive():
+                        continue
+                    # the producer may have queued its last items just before it exited
+                    try:
+                        item = out_queue.get(timeout=1.)
+                    except queue.Empty:
+                        raise RuntimeError("the producer reading {} exited before the end of the file"
+                                           .format(self.file_name)) from None
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                rows, chunk = item
+                # rows_read counts raw input rows handed to the consumer, usable as a resume cursor
+                self.rows_read = self.rows_read + rows
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if self.worker is not None:
+            self.stop.set()
+            self.worker.join(timeout=5)
+            if self.use_process and self.worker.is_alive():
+                self.worker.terminate()
+            self.worker = None
@@ -1,11 +1,13 @@
-import multiprocessing as mp
+import json
+import os
 from enum import Enum
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
+import cl_mod
 import mean_shift as ms
+import utils as ut
 
 
 class CLCellShape(Enum):
@@ -22,19 +24,32 @@ class ClusteringType(Enum):
     MS = 1
 
 
+def run_starts(keys):
+    # start index of every run of equal rows in keys, which must be grouped (e.g. sorted) already
+    if len(keys) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(([0], np.flatnonzero(np.any(np.diff(keys, axis=0) != 0, axis=1)) + 1))
+
+
 def cluster_worker(obj):
     try:
         obj.query()
-        return obj
     except:
-        return obj
+        pass
+    # do not send the points back, the map re-attaches its views
+    obj.points = None
+    return obj
 
 class CLCell:
     def __init__(self, corner, data, clustering_type, cell_shpae, kernel_bandwidth=0.5, cell_type=CLCellType.BATCH,
-                 micro_cell=0.1):
+                 micro_cell=0.1, offset=None, length=None):
         self.corner = corner
         self.cell_shape = cell_shpae  # is this useful?
         self.data = data
+        # batch cells are a (offset, length) view into the cell-sorted point array of the map
+        self.offset = offset
+        self.length = length
+        self.points = None
         self.clustering_results = None
         self.clustering_type = clustering_type
         self.kernel_bandwidth = kernel_bandwidth
@@ -52,6 +67,10 @@ class CLCell:
             np.array([self.cell_resolution / 2, self.cell_resolution / 2]), decimals=0)
         return (corner[0], corner[1])
 
+    def get_cell_centers_vec(self, points):
+        return np.round(points / self.cell_resolution, decimals=0) * self.cell_resolution - np.round(
+            np.array([self.cell_resolution / 2, self.cell_resolution / 2]), decimals=0)
+
     def update(self, data):
         if self.cell_type == CLCellType.STREAM:
             l_data=data[['velocity', 'motion_angle']].to_numpy()
@@ -67,8 +86,26 @@ class CLCell:
                     self.sums.append(d)
                     self.count.append(1)
 
-    def query(self):
+    def get_weight(self):
+        # number of observations the cell was built from
+        if self.cell_type is CLCellType.STREAM:
+            return float(np.sum(self.count))
+        if self.length is not None:
+            return self.length
+        return len(self.data)
+
+    def decay(self, factor, min_weight):
+        # scales sums and counts alike, so micro-cell means are unchanged; light micro-cells are evicted
+        count = np.array(self.count, dtype=float) * factor
+        sums = np.array(self.sums, dtype=float).reshape(-1, 2) * factor
+        keep = count >= min_weight
+        self.corners = [c for c, k in zip(self.corners, keep) if k]
+        self.sums = list(sums[keep])
+        self.count = count[keep].tolist()
 
+    def query(self):
+        # a failed clustering leaves no results rather than those of the previous data
+        self.clustering_results = None
         try:
             mean_shifter = ms.MeanShift()
             if self.cell_type is CLCellType.STREAM:
@@ -76,12 +113,16 @@ class CLCell:
                 self.clustering_results \
                     = mean_shifter.cluster(
                                     cell_means,
-                                    kernel_bandwidth=self.kernel_bandwidth)
+                                    kernel_bandwidth=self.kernel_bandwidth,
+                                    angle_column=1,
+                                    weights=np.array(self.count, dtype=float))
             elif self.cell_type is CLCellType.BATCH:
+                points = self.points if self.points is not None else self.data[['velocity', 'motion_angle']].to_numpy()
                 self.clustering_results \
                     = mean_shifter.cluster(
-                                self.data[['velocity', 'motion_angle']].to_numpy(),
-                                kernel_bandwidth=self.kernel_bandwidth)
+                                points,
+                                kernel_bandwidth=self.kernel_bandwidth,
+                                angle_column=1)
             else:
                 print("Unknown clustering type")
         except Exception as e:
@@ -104,31 +145,125 @@ class CLMap:
         self.initial = True
         self.p_array = []
         self.total_number_of_observations = 0
+        self.keep_data = True
+        self.kernel_bandwidth = 0.5
+        self.micro_cell = 0.1
+        self.cell_index = np.empty(0, dtype=np.int64)
+        self.cell_points = np.empty((0, 2))
+        self.half_life = None
+        self.min_weight = 0.05
+        self.last_time = None
+        # corners of cells whose data changed since they were last clustered, of cells clustered since
+        # the last export and of cells evicted since the last export
+        self.unclustered = set()
+        self.changed_cells = set()
+        self.removed_cells = set()
         if pool_num == -1:
-            self.pool_num = mp.cpu_count()
+            self.pool_num = os.cpu_count()
         else:
             self.pool_num = pool_num
 
     def get_cell_corner_in_dimension(self, coord):
         return np.round(coord / self.grid_step, decimals=0) * self.grid_step - np.round(self.grid_step / 2, decimals=0)
 
+    def set_data_extent(self, extent):
+        # extent is (x_min, x_max, y_min, y_max) of the points, kept as the corners of their cells
+        for key, coord in zip(('x_min', 'x_max', 'y_min', 'y_max'), extent):
+            self.data_extent[key] = self.get_cell_corner_in_dimension(coord)
+
     def get_cell_corner(self, point):
         corner = np.round(point / self.grid_step, decimals=0) * self.grid_step - np.round(
             np.array([self.grid_step / 2, self.grid_step / 2]), decimals=0)
         return (corner[0], corner[1])
 
+    def get_cell_partition(self, points):
+        # returns the cell corners, the row indices sorted by cell and the start of every cell in them
+        offset = np.round(self.grid_step / 2, decimals=0)
+        point_index = np.arange(points.shape[0])
+        if self.grid_type == CLCellShape.SQUARE:
+            keys = np.round(points / self.grid_step, decimals=0).astype(np.int64)
+            members = point_index
+        else:
+            # grid hash over the lattice of circle centres: a point can only lie in the circles whose
+            # centres are within ceil(radius / step) lattice steps of its nearest centre
+            shift = self.grid_step / 2 - offset
+            nearest = np.round((points - shift) / self.grid_step, decimals=0).astype(np.int64)
+            reach = int(np.ceil(self.grid_radius / self.grid_step))
+            radius_sq = self.grid_radius ** 2
+            keys = []
+            members = []
+            for dx in range(-reach, reach + 1):
+                for dy in range(-reach, reach + 1):
+                    lattice = nearest + np.array([dx, dy])
+                    delta = points - (lattice * self.grid_step + shift)
+                    inside = np.einsum('ij,ij->i', delta, delta) <= radius_sq
+                    keys.append(lattice[inside])
+                    members.append(point_index[inside])
+            keys = np.concatenate(keys)
+            members = np.concatenate(members)
+        if members.size == 0:
+            return [], members, np.empty(0, dtype=np.int64)
+        order = np.lexsort((members, keys[:, 1], keys[:, 0]))
+        keys = keys[order]
+        members = members[order]
+        starts = run_starts(keys)
+        corners = keys[starts] * self.grid_step - offset
+        return [(c[0], c[1]) for c in corners], members, starts
+
+    def get_cell_members(self, points):
+        corners, members, starts = self.get_cell_partition(points)
+        if len(corners) == 0:
+            return [], []
+        return corners, np.split(members, starts[1:])
+
+    def update_cell(self, corner, data):
+        cell_to_update = next((x for x in self.cells_data if x.corner == corner), None)
+        if cell_to_update is None:
+            cell = CLCell(corner, [], self.clustering_type, self.grid_type, self.kernel_bandwidth, CLCellType.STREAM,
+                          self.micro_cell)
+            cell.update(data)
+            self.cells_data.append(cell)
+            self.removed_cells.discard(corner)
+        else:
+            cell_to_update.update(data)
+        self.unclustered.add(corner)
+
+    def decay(self, time):
+        if self.last_time is not None and time > self.last_time:
+            factor = 0.5 ** ((time - self.last_time) / self.half_life)
+            for cell in self.cells_data:
+                length = len(cell.corners)
+                cell.decay(factor, self.min_weight)
+                # clustering weighs micro-cells by their decayed counts; decay scales all of a cell's counts
+                # alike, so only evictions (and new observations) change its clustering
+                if len(cell.corners) < length:
+                    self.unclustered.add(cell.corner)
+            for cell in self.cells_data:
+                if len(cell.corners) == 0:
+                    self.unclustered.discard(cell.corner)
+                    self.changed_cells.discard(cell.corner)
+                    self.removed_cells.add(cell.corner)
+            self.cells_data = [cell for cell in self.cells_data if len(cell.corners) > 0]
+        if self.last_time is None or time > self.last_time:
+            self.last_time = time
+
+    def attach_points(self, cell):
+        if cell.offset is not None:
+            cell.points = self.cell_points[cell.offset:cell.offset + cell.length]
+        return cell
+
     def set_up_map(self, **kwargs):
         self.grid_step = kwargs.get('step', 1)
         self.grid_radius = kwargs.get('radius', 1)
         self.grid_type = kwargs.get('type', CLCellShape.SQUARE)
         self.grid_precision = kwargs.get('precision', 2)
         self.processing_type = kwargs.get('processing', CLCellType.BATCH)
-
-        # add column for future discretisation according to CLCellType
-        if self.grid_type == CLCellShape.CIRCULAR:
-            pass
-        if self.grid_type == CLCellShape.SQUARE:
-            self.data["corners"] = ""
+        self.keep_data = kwargs.get('keep_data', True)
+        self.kernel_bandwidth = kwargs.get('kernel_bandwidth', 0.5)
+        self.micro_cell = kwargs.get('micro_cell', 0.1)
+        # sliding window for STREAM maps: accumulated statistics halve every half_life seconds of data time
+        self.half_life = kwargs.get('half_life', None)
+        self.min_weight = kwargs.get('min_weight', 0.05)
 
     def load_data(self, data):
         self.total_number_of_observations = len(data["time"].unique())
@@ -137,22 +272,29 @@ class CLMap:
         data['z'] = data['z']/1000.
         data['velocity'] = data['velocity']/1000.
         if self.processing_type is CLCellType.BATCH:
-            self.data = data
-            self.data_extent['x_min'] = self.get_cell_corner_in_dimension(self.data['x'].min())
-            self.data_extent['x_max'] = self.get_cell_corner_in_dimension(self.data['x'].max())
-            self.data_extent['y_min'] = self.get_cell_corner_in_dimension(self.data['y'].min())
-            self.data_extent['y_max'] = self.get_cell_corner_in_dimension(self.data['y'].max())
-            if self.grid_type == CLCellShape.CIRCULAR:
-                pass
-            if self.grid_type == CLCellShape.SQUARE:
-                self.data['corners'] = self.data.apply(lambda row: self.get_cell_corner(np.array([row['x'], row['y']])),
-                                                       axis=1)
-                cells = self.data['corners'].unique()
-                for cell_data in cells:
-                    cell = CLCell(cell_data, self.data.loc[self.data['corners'] == cell_data], self.clustering_type,
-                                  self.grid_type)
-                    self.cells_data.append(cell)
+            # cell_index holds row positions in self.data, which grows by every load
+            rows = len(self.data)
+            if self.keep_data:
+                self.data = data if rows == 0 else pd.concat([self.data, data], ignore_index=True)
+            for key, column, pick in (('x_min', 'x', min), ('x_max', 'x', max), ('y_min', 'y', min),
+                                      ('y_max', 'y', max)):
+                corner = self.get_cell_corner_in_dimension(getattr(data[column], pick.__name__)())
+                self.data_extent[key] = corner if self.data_extent[key] is None else pick(self.data_extent[key], corner)
+            # one contiguous array of the clustering columns, sorted by cell; cells only keep views into it
+            corners, members, starts = self.get_cell_partition(data[['x', 'y']].to_numpy())
+            base = len(self.cell_points)
+            self.cell_index = np.concatenate([self.cell_index, members + rows])
+            self.cell_points = np.concatenate([self.cell_points,
+                                               data[['velocity', 'motion_angle']].to_numpy(dtype=float)[members]])
+            ends = np.append(starts[1:], len(members))
+            for cell_data, start, end in zip(corners, starts, ends):
+                cell = CLCell(cell_data, None, self.clustering_type, self.grid_type, self.kernel_bandwidth,
+                              offset=base + start, length=end - start)
+                self.cells_data.append(self.attach_points(cell))
+                self.unclustered.add(cell_data)
         elif self.processing_type is CLCellType.STREAM:
+            if self.half_life is not None and len(data) > 0:
+                self.decay(data['time'].max())
             if self.initial:
                 self.data_extent['x_min'] = self.get_cell_corner_in_dimension(data['x'].min())
                 self.data_extent['x_max'] = self.get_cell_corner_in_dimension(data['x'].max())
@@ -173,26 +315,99 @@ class CLMap:
                                                                                                       'y_max'] > self.get_cell_corner_in_dimension(
                     data['y'].max()) else self.get_cell_corner_in_dimension(data['y'].max())
 
-            if self.grid_type == CLCellShape.CIRCULAR:
-                pass
-            if self.grid_type == CLCellShape.SQUARE:
-                data['corners'] = data.apply(lambda row: self.get_cell_corner(np.array([row['x'], row['y']])),
-                                             axis=1)
-                cells = data['corners'].unique()
-                for cell_data in cells:
-                    cell_to_update = next((x for x in self.cells_data if x.corner == cell_data), None)
-                    if cell_to_update is None:
-                        cell = CLCell(cell_data, [], self.clustering_type, self.grid_type, 0.5, CLCellType.STREAM)
-                        cell.update(data.loc[data['corners'] == cell_data])
-                        self.cells_data.append(cell)
-                    else:
-                        cell_to_update.update(data.loc[data['corners'] == cell_data])
-
-    def cluster_data(self):
+            corners, members = self.get_cell_members(data[['x', 'y']].to_numpy())
+            for cell_data, indices in zip(corners, members):
+                self.update_cell(cell_data, data.iloc[indices])
+
+    def cluster_data(self, only_changed=False):
+        # imported here, so loading and exporting maps does not pay for them
+        import multiprocessing as mp
+        from tqdm import tqdm
+
+        # with only_changed, cells whose data did not change since they were last clustered keep their results
+        indices = [i for i, obj in enumerate(self.cells_data) if not only_changed or obj.corner in self.unclustered]
+        cells = [self.cells_data[i] for i in indices]
         # if self.processing_type is CLCellType.BATCH:
-        with mp.Pool(self.pool_num) as p:
-            self.cells_data = list(
-                tqdm(p.imap(cluster_worker, (obj for obj in self.cells_data)), total=len(self.cells_data)))
+        if self.pool_num == 1 or len(cells) == 0:
+            # in-process, also usable from inside pool workers which cannot start their own pool
+            cells = [cluster_worker(obj) for obj in cells]
+        else:
+            # pickling a cell sends only its slice of cell_points to the worker
+            with mp.Pool(self.pool_num) as p:
+                cells = list(tqdm(p.imap(cluster_worker, (obj for obj in cells)), total=len(cells)))
+        for i, obj in zip(indices, cells):
+            self.cells_data[i] = self.attach_points(obj)
+            self.changed_cells.add(obj.corner)
+        self.unclustered.clear()
 
             # for obj in tqdm(self.cells_data):
             #     obj.cluster_points()
+
+    def pop_changes(self):
+        # cells clustered and corners evicted since the last call, for incremental exports (see cl_delta)
+        changed = [cell for cell in self.cells_data if cell.corner in self.changed_cells]
+        removed = sorted(self.removed_cells)
+        self.changed_cells = set()
+        self.removed_cells = set()
+        return changed, removed
+
+    def get_mod(self, **kwargs):
+        return cl_mod.CLMoD.from_map(self, **kwargs)
+
+    def export(self, path, **kwargs):
+        # writes the clustered map for the read-only runtime in cl_mod
+        self.get_mod(**kwargs).save(path)
+
+    def save_checkpoint(self, path, cursor=0, **meta):
+        # only the streaming state is stored: micro-cell sums and counts, not clustering results
+        cells = [cell for cell in self.cells_data if len(cell.corners) > 0]
+        lengths = np.array([len(cell.corners) for cell in cells], dtype=np.int64)
+        state = {
+            'grid': np.array([self.grid_step, self.grid_radius, self.grid_precision], dtype=float),
+            'grid_type': np.array(self.grid_type.value),
+            'processing_type': np.array(self.processing_type.value),
+            'extent': np.array([np.nan if self.data_extent[k] is None else self.data_extent[k]
+                                for k in ('x_min', 'x_max', 'y_min', 'y_max')], dtype=float),
+            'initial': np.array(self.initial),
+            'total_number_of_observations': np.array(self.total_number_of_observations),
+            'last_time': np.array(np.nan if self.last_time is None else self.last_time, dtype=float),
+            'cell_corners': np.array([cell.corner for cell in cells], dtype=float).reshape(-1, 2),
+            'cell_lengths': lengths,
+            'cell_resolution': np.array([cell.cell_resolution for cell in cells], dtype=float),
+            'kernel_bandwidth': np.array([cell.kernel_bandwidth for cell in cells], dtype=float),
+            'micro_corners': np.array([c for cell in cells for c in cell.corners], dtype=float).reshape(-1, 2),
+            'micro_sums': np.array([s for cell in cells for s in cell.sums], dtype=float).reshape(-1, 2),
+            'micro_count': np.array([c for cell in cells for c in cell.count]),
+            'cursor': np.array(cursor, dtype=np.int64),
+            'meta': np.array(json.dumps(meta)),
+        }
+        # a crash while saving leaves the last complete checkpoint in place
+        with ut.atomic_write(path) as f:
+            np.savez_compressed(f, **state)
+
+    def load_checkpoint(self, path):
+        with np.load(path) as f:
+            state = {k: f[k] for k in f.files}
+        self.grid_step, self.grid_radius, self.grid_precision = state['grid'].tolist()
+        self.grid_type = CLCellShape(int(state['grid_type']))
+        self.processing_type = CLCellType(int(state['processing_type']))
+        for k, v in zip(('x_min', 'x_max', 'y_min', 'y_max'), state['extent']):
+            self.data_extent[k] = None if np.isnan(v) else v
+        self.initial = bool(state['initial'])
+        self.total_number_of_observations = int(state['total_number_of_observations'])
+        self.last_time = None if np.isnan(state['last_time']) else float(state['last_time'])
+        self.cells_data = []
+        ends = np.cumsum(state['cell_lengths'])
+        for corner, end, length, resolution, bandwidth in zip(state['cell_corners'], ends, state['cell_lengths'],
+                                                              state['cell_resolution'], state['kernel_bandwidth']):
+            cell = CLCell((corner[0], corner[1]), [], self.clustering_type, self.grid_type, bandwidth,
+                          CLCellType.STREAM, resolution)
+            cell.corners = [(c[0], c[1]) for c in state['micro_corners'][end - length:end]]
+            cell.sums = list(state['micro_sums'][end - length:end])
+            cell.count = state['micro_count'][end - length:end].tolist()
+            self.cells_data.append(cell)
+        # clustering results are not stored, every restored cell has to be clustered again
+        self.unclustered = set(cell.corner for cell in self.cells_data)
+        self.changed_cells = set()
+        self.removed_cells = set()
+        return int(state['cursor']), json.loads(str(state['meta']))
@@ -1,22 +1,139 @@
-import matplotlib.pyplot as plt
+import queue
+import threading
+
 import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
 import helpers as he
 
 
+def raster_bins(x, y, extent, resolution):
+    # flat pixel index of every point on a grid over extent (x_min, x_max, y_min, y_max), -1 outside it
+    shape = (int(np.ceil((extent[3] - extent[2]) / resolution)), int(np.ceil((extent[1] - extent[0]) / resolution)))
+    col = np.floor((np.asarray(x) - extent[0]) / resolution).astype(np.int64)
+    row = np.floor((np.asarray(y) - extent[2]) / resolution).astype(np.int64)
+    inside = (col >= 0) & (col < shape[1]) & (row >= 0) & (row < shape[0])
+    return np.where(inside, row * shape[1] + col, -1), shape
+
+
+def density_image(x, y, extent, resolution):
+    # number of points per pixel, row 0 at y_min (draw with origin='lower')
+    bins, shape = raster_bins(x, y, extent, resolution)
+    return np.bincount(bins[bins >= 0], minlength=shape[0] * shape[1]).reshape(shape)
+
+
+def mode_arrows(cl_map):
+    # (N, 4) array of cell centre x, y and the u, v of every component mean, from the packed map
+    mod = cl_map.get_mod()
+    cell, component = np.nonzero(mod.weights > 0)
+    u, v = he.pol2cart(mod.means[cell, component, 0], mod.means[cell, component, 1])
+    centres = mod.corners[cell] + cl_map.grid_step / 2
+    return np.column_stack((centres, u, v))
+
+
+def render_frame(path, image=None, extent=None, arrows=None, markers=None, title=None, xlim=None, ylim=None):
+    # draws on a Figure of its own with the Agg canvas, not pyplot, so it is safe off the main thread
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.set_aspect('equal')
+    if image is not None:
+        ax.imshow(np.ma.masked_equal(image, 0), extent=extent, origin='lower', cmap='plasma',
+                  interpolation='nearest')
+    if arrows is not None and len(arrows) > 0:
+        ax.quiver(arrows[:, 0], arrows[:, 1], arrows[:, 2], arrows[:, 3], units='xy')
+    if markers is not None:
+        ax.scatter(markers[0], markers[1], marker="*", c="b")
+    if xlim is not None:
+        ax.set_xlim(*xlim)
+    if ylim is not None:
+        ax.set_ylim(*ylim)
+    if title is not None:
+        ax.set_title(title)
+    fig.savefig(path, bbox_inches='tight')
+
+
+class FrameWriter:
+    # renders frames with render_frame on a background thread. write() never waits: when max_pending
+    # frames are already queued the new frame is dropped and counted in dropped.
+    def __init__(self, max_pending=2):
+        self.frames = queue.Queue(max_pending)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                return
+            try:
+                render_frame(*frame[0], **frame[1])
+            except Exception as e:
+                print(e)
+
+    def write(self, path, **kwargs):
+        # the arrays passed are drawn later, callers must not modify them afterwards
+        try:
+            self.frames.put_nowait(((path,), kwargs))
+            return True
+        except queue.Full:
+            self.dropped = self.dropped + 1
+            return False
+
+    def close(self):
+        # waits for the queued frames to be written
+        self.frames.put(None)
+        self.thread.join()
+
+
 class CLVisualisation:
-    def __init__(self, cl_map):
+    def __init__(self, cl_map, resolution=None):
         self.map = cl_map
+        # pixel size of the rasterised plots, defaults to a tenth of a cell
+        self.resolution = resolution
+
+    def get_extent(self):
+        step = self.map.grid_step
+        return (self.map.data_extent['x_min'] - step, self.map.data_extent['x_max'] + 2 * step,
+                self.map.data_extent['y_min'] - step, self.map.data_extent['y_max'] + 2 * step)
+
+    def get_resolution(self):
+        return self.resolution if self.resolution is not None else self.map.grid_step / 10
+
+    def get_locations(self):
+        # x and y of the loaded points, which only a BATCH map built with keep_data keeps
+        if 'x' not in self.map.data:
+            raise ValueError("the map holds no points to plot, load the data into a BATCH map with keep_data=True")
+        return self.map.data['x'].to_numpy(), self.map.data['y'].to_numpy()
 
     def show_raw_locations(self):
+        x, y = self.get_locations()
+        # pyplot is imported here, so modules that only render frames do not set up an interactive backend
+        import matplotlib.pyplot as plt
+        extent = self.get_extent()
+        image = density_image(x, y, extent, self.get_resolution())
         fig, ax = plt.subplots(nrows=1, ncols=1)
-        ax.scatter(self.map.data['x'], self.map.data['y'])
+        ax.imshow(np.ma.masked_equal(image, 0), extent=extent, origin='lower', cmap='plasma', interpolation='nearest')
         plt.show()
 
     def show_discretised_locations(self):
+        # every pixel takes the colour of a cell with points in it; overlapping circular cells share pixels
+        x, y = self.get_locations()
+        import matplotlib.pyplot as plt
+        cells = [cell for cell in self.map.cells_data if cell.offset is not None]
+        lengths = np.array([cell.length for cell in cells], dtype=np.int64)
+        members = np.concatenate([self.map.cell_index[cell.offset:cell.offset + cell.length] for cell in cells]) \
+            if len(cells) > 0 else np.empty(0, dtype=np.int64)
+        labels = np.repeat(np.arange(len(cells)), lengths)
+        extent = self.get_extent()
+        bins, shape = raster_bins(x[members], y[members], extent, self.get_resolution())
+        image = np.full(shape[0] * shape[1], -1)
+        image[bins[bins >= 0]] = labels[bins >= 0] % 20
         fig, ax = plt.subplots(nrows=1, ncols=1)
-        for cell in self.map.cells_data:
-            ax.scatter(cell.data['x'], cell.data['y'])
+        ax.imshow(np.ma.masked_less(image.reshape(shape), 0), extent=extent, origin='lower', cmap='tab20',
+                  vmin=0, vmax=19, interpolation='nearest')
         ax.set_xticks(
             np.arange(self.map.data_extent['x_min'], self.map.data_extent['x_max'] + 2 * self.map.grid_step,
                       self.map.grid_step))
@@ -27,13 +144,8 @@ class CLVisualisation:
         plt.plot()
 
     def show_directions(self):
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots(nrows=1, ncols=1)
-        plot_data = []
-        for cell in self.map.cells_data:
-            for m in cell.clustering_results.mean_values:
-                u, v = he.pol2cart(m[0], m[1])
-                row = [cell.corner[0] + self.map.grid_step / 2, cell.corner[1] + self.map.grid_step / 2, u, v]
-                plot_data.append(row)
-        plot_data = np.array(plot_data)
+        plot_data = mode_arrows(self.map)
         ax.quiver(plot_data[:, 0], plot_data[:, 1], plot_data[:, 2], plot_data[:, 3],units='xy')
         plt.show()
@@ -6,3 +6,40 @@ def cl_gauss_2d(mu, sigma, n):
     ret = np.random.multivariate_normal(mu, sigma, n)
     ret[:,0]=cl_a.wrap_to_2pi_vec(ret[:, 0])
     return ret
+
+
+def alias_table(p):
+    # Vose's alias method: draw column j uniformly, keep it with probability prob[j], else take alias[j]
+    p = np.asarray(p, dtype=float)
+    n = len(p)
+    prob = np.zeros(n)
+    alias = np.arange(n)
+    total = np.sum(p)
+    if n == 0 or total <= 0:
+        return np.ones(n), alias
+    scaled = p * n / total
+    small = [i for i in range(n) if scaled[i] < 1]
+    large = [i for i in range(n) if scaled[i] >= 1]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1
+        if scaled[l] < 1:
+            small.append(l)
+        else:
+            large.append(l)
+    prob[small + large] = 1
+    return prob, alias
+
+
+def alias_tables(p):
+    # one alias table per row of p
+    tables = [alias_table(row) for row in np.asarray(p, dtype=float)]
+    return np.array([t[0] for t in tables]).reshape(np.shape(p)), np.array([t[1] for t in tables]).reshape(np.shape(p))
+
+
+def alias_draw(prob, alias, u_index, u_accept):
+    # u_index in [0, n) picks the column, u_accept in [0, 1) decides between it and its alias
+    return np.where(u_accept < prob[u_index], u_index, alias[u_index])
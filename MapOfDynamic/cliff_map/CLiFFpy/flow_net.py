@@ -1,8 +1,10 @@
+import argparse
+
 import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 import matplotlib.patches as patches
-from sklearn.cluster import DBSCAN
+from scipy import ndimage
 
 # start goal region in x,y,w,h
 REGION_UP_LEFT = [-25,5,7,20]
@@ -28,48 +30,78 @@ def plot_cluster(ax,X_train,cluster_pred):
 
     return 
 
-def clustering_start_goal(start_goal_data):
-
+def grid_density_clustering(points, cell_size=0.5, min_count=4, min_points=40):
+    # occupancy counts on a grid of cell_size, 8-connected components of the cells holding at least
+    # min_count points, components with fewer than min_points points are noise. Returns the label
+    # of every point (-1 for noise) and the bounding box of every component in x,y,w,h.
+    if len(points) == 0:
+        return np.empty(0, dtype=int), []
+    origin = points.min(axis=0)
+    bins = np.floor((points - origin) / cell_size).astype(np.int64)
+    shape = tuple(bins.max(axis=0) + 1)
+    flat = np.ravel_multi_index((bins[:, 0], bins[:, 1]), shape)
+    counts = np.bincount(flat, minlength=shape[0] * shape[1]).reshape(shape)
+    components, n = ndimage.label(counts >= min_count, structure=np.ones((3, 3)))
+    sizes = np.bincount(components.ravel(), weights=counts.ravel(), minlength=n + 1)
+    # relabel the components that are large enough as 0..k-1, everything else as -1
+    keep = sizes >= min_points
+    keep[0] = False
+    relabel = np.full(n + 1, -1)
+    relabel[keep] = np.arange(np.count_nonzero(keep))
+    regions = []
+    for component, box in enumerate(ndimage.find_objects(components), start=1):
+        if keep[component]:
+            regions.append([origin[0] + box[0].start * cell_size, origin[1] + box[1].start * cell_size,
+                            (box[0].stop - box[0].start) * cell_size, (box[1].stop - box[1].start) * cell_size])
+    return relabel[components.ravel()[flat]], regions
+
+
+def clustering_start_goal(start_goal_data, method='grid', **kwargs):
+    # method 'grid' clusters with grid_density_clustering (kwargs are passed on), 'dbscan' with scikit-learn
     start_pos = start_goal_data[:,2:4]/1000.
     end_pos = start_goal_data[:,5:7]/1000.
-    dbscan = DBSCAN(eps=1, min_samples=40)
-    cluster_pred_start = dbscan.fit_predict(start_pos)
-    cluster_pred_end = dbscan.fit_predict(end_pos)
+    if method == 'grid':
+        cluster_pred_start, _ = grid_density_clustering(start_pos, **kwargs)
+        cluster_pred_end, _ = grid_density_clustering(end_pos, **kwargs)
+    else:
+        from sklearn.cluster import DBSCAN
+        dbscan = DBSCAN(eps=1, min_samples=40)
+        cluster_pred_start = dbscan.fit_predict(start_pos)
+        cluster_pred_end = dbscan.fit_predict(end_pos)
 
     return start_pos, end_pos, cluster_pred_start, cluster_pred_end
 
-def manual_labeling_start_goal_region(start_goal_data):
-    
-    start_goal_region_labels = []
-    for i in range(start_goal_data.shape[0]):
-        start_pos = start_goal_data[i,2:4]/1000.
-        end_pos = start_goal_data[i,5:7]/1000.
-        region_label = []
-        in_region = False
-        for region_id, region in enumerate(REGION_LIST):
-            in_region = in_box(start_pos, region)
-            if in_region:
-                region_label.append(region_id)
-                break
-        if not in_region:
-            region_label.append(-1)
-        in_region = False
-        for region_id, region in enumerate(REGION_LIST):
-            in_region = in_box(end_pos, region)
-            if in_region:
-                region_label.append(region_id)
-                break
-        if not in_region:
-            region_label.append(-1)
-        start_goal_region_labels.append(region_label)
-
-    start_goal_region_labels = np.array(start_goal_region_labels)
+
+def auto_labeling_start_goal_region(start_goal_data, **kwargs):
+    # starts and goals are clustered together, so both share region ids; every point keeps the label of
+    # its grid cell's component (-1 for noise), the boxes of the components are returned for plotting
+    points = np.concatenate([start_goal_data[:,2:4], start_goal_data[:,5:7]])/1000.
+    labels, regions = grid_density_clustering(points, **kwargs)
+    start_goal_region_labels = np.column_stack(np.split(labels, 2))
+    start_goal_data_with_labels = np.concatenate([start_goal_data,
+                                                  start_goal_region_labels],
+                                                  axis=1)
+
+    return start_goal_data_with_labels, regions
+
+def manual_labeling_start_goal_region(start_goal_data, region_list=REGION_LIST):
+    # every start and end is labelled with the first hand-coded region containing it, -1 if there is none
+    start_goal_region_labels = np.column_stack([first_box(start_goal_data[:,2:4]/1000., region_list),
+                                                first_box(start_goal_data[:,5:7]/1000., region_list)])
     start_goal_data_with_labels = np.concatenate([start_goal_data,
                                                   start_goal_region_labels],
                                                   axis=1)
 
     return start_goal_data_with_labels
 
+def first_box(points, region_list):
+    if len(region_list) == 0:
+        return np.full(points.shape[0], -1)
+    boxes = np.asarray(region_list, dtype=float)
+    inside = ((points[:, None, 0] >= boxes[:, 0]) & (points[:, None, 0] <= boxes[:, 0] + boxes[:, 2]) &
+              (points[:, None, 1] >= boxes[:, 1]) & (points[:, None, 1] <= boxes[:, 1] + boxes[:, 3]))
+    return np.where(inside.any(axis=1), inside.argmax(axis=1), -1)
+
 def in_box(point, xywh):
     if point[0]<xywh[0] or point[0]>xywh[0]+xywh[2]:
         return False
@@ -98,6 +130,13 @@ def adjecent_matrix_flow_net(source_sink_label):
             ad_matrix[source,sink] = ad_matrix[source,sink] + 1
     return ad_matrix
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Label start and goal regions')
+    # discover the regions with grid_density_clustering instead of using REGION_LIST
+    parser.add_argument('--auto_regions', action='store_true')
+    parser.add_argument('--cell_size', type=float, default=0.5)
+    parser.add_argument('--min_count', type=int, default=4)
+    parser.add_argument('--min_points', type=int, default=40)
+    args = parser.parse_args()
     fig, ax = plt.subplots()
     start_goal_data = np.genfromtxt("start_goal.csv",delimiter=",")
     
@@ -107,7 +146,12 @@ if __name__ == "__main__":
     # plot_cluster(ax,end_pos,cluster_pred_end)
     # for region in REGION_LIST:
     #     plot_box(ax,region)
-    start_goal_data_with_labels = manual_labeling_start_goal_region(start_goal_data)
+    if args.auto_regions:
+        start_goal_data_with_labels, region_list = auto_labeling_start_goal_region(
+            start_goal_data, cell_size=args.cell_size, min_count=args.min_count, min_points=args.min_points)
+        print("regions:", region_list)
+    else:
+        start_goal_data_with_labels = manual_labeling_start_goal_region(start_goal_data)
     np.savetxt("start_goal_with_label.csv",
                start_goal_data_with_labels,
                delimiter=",",fmt='%f')
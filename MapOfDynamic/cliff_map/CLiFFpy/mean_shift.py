@@ -34,7 +34,8 @@ class MeanShift(object):
         self.distance = distance
         self.weight = weight
 
-    def cluster(self, points, kernel_bandwidth, iteration_callback=None):
+    def cluster(self, points, kernel_bandwidth, iteration_callback=None, angle_column=0, weights=None):
+        # weights, e.g. observation counts, scale the kernel of every point and its share of its cluster
         if iteration_callback:
             iteration_callback(points, 0)
         shift_points = np.array(points)
@@ -56,7 +57,7 @@ class MeanShift(object):
                     continue
                 p_new = shift_points[i]
                 p_new_start = p_new
-                p_new = self._shift_point(p_new, points, kernel_bandwidth)
+                p_new = self._shift_point(p_new, points, kernel_bandwidth, weights)
 
                 dist = self.distance(p_new, p_new_start)
 
@@ -73,31 +74,66 @@ class MeanShift(object):
         point_grouper = pg.PointGrouper()
         group_assignments = point_grouper.group_points(shift_points.tolist())
 
-        return MeanShiftResult(points, shift_points, group_assignments, history)
+        return MeanShiftResult(points, shift_points, group_assignments, history, angle_column, weights)
 
-    def _shift_point(self, point, points, kernel_bandwidth):
+    def _shift_point(self, point, points, kernel_bandwidth, weights=None):
         # from http://en.wikipedia.org/wiki/Mean-shift
-        points = np.array(points)
-        point_rep = np.tile(point, [len(points), 1])
-        dist = self.distance(point_rep, points)
+        points = np.asarray(points)
+        # the vectorised distances broadcast a single point against all points
+        dist = self.distance(point, points)
         point_weights = self.kernel(dist, kernel_bandwidth)
+        if weights is not None:
+            point_weights = point_weights * weights
 
         shifted_point = self.weight(points, point_weights)
         return shifted_point
 
 
+def cluster_statistics(points, cluster_ids, angle_column=0, weights=None):
+    # mixing factors (K,), means (K, 2) and covariances (K, 2, 2) of the K clusters, in one pass over
+    # the points sorted by cluster id. The angle column has a circular mean and its deviations are
+    # wrapped to [-pi, pi]; a cluster of a single point has a zero covariance. Covariances use
+    # reliability weights, so scaling all weights alike leaves them unchanged.
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    cluster_ids = np.asarray(cluster_ids).ravel()
+    if cluster_ids.size == 0:
+        return np.empty(0), np.empty((0, 2)), np.empty((0, 2, 2))
+    weights = np.ones(cluster_ids.size) if weights is None else np.asarray(weights, dtype=float).ravel()
+    order = np.argsort(cluster_ids, kind='stable')
+    ids = cluster_ids[order]
+    weights = weights[order]
+    starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+    counts = np.diff(np.append(starts, ids.size))
+    totals = np.add.reduceat(weights, starts)
+    member = np.repeat(np.arange(starts.size), counts)
+    linear = 1 - angle_column
+
+    means = np.empty((starts.size, 2))
+    deviations = np.empty((ids.size, 2))
+    column = points[order, linear]
+    means[:, linear] = np.add.reduceat(weights * column, starts) / totals
+    deviations[:, linear] = column - means[member, linear]
+    column = points[order, angle_column]
+    means[:, angle_column] = np.arctan2(np.add.reduceat(weights * np.sin(column), starts),
+                                        np.add.reduceat(weights * np.cos(column), starts))
+    deviations[:, angle_column] = cla.wrap_to_pi_vec(column - means[member, angle_column])
+
+    covariances = np.zeros((starts.size, 2, 2))
+    ddof = totals - np.add.reduceat(weights * weights, starts) / totals
+    spread = counts > 1
+    for i, j in ((0, 0), (0, 1), (1, 1)):
+        np.divide(np.add.reduceat(weights * deviations[:, i] * deviations[:, j], starts), ddof,
+                  out=covariances[:, i, j], where=spread)
+        covariances[:, j, i] = covariances[:, i, j]
+    return totals / totals.sum(), means, covariances
+
+
 class MeanShiftResult:
-    def __init__(self, original_points, shifted_points, cluster_ids, history):
+    def __init__(self, original_points, shifted_points, cluster_ids, history, angle_column=0, weights=None):
         self.original_points = original_points
         self.shifted_points = shifted_points
         self.cluster_ids = cluster_ids
         self.history = history
-        self.mixing_factors = []
-        self.covariances = []
-        self.mean_values = []
-        # compute GMM parameters
-        unique_cluster_ids, counts = np.unique(self.cluster_ids, return_counts=True)
-        for uid, c in zip(unique_cluster_ids, counts):
-            self.mixing_factors.append(c / self.cluster_ids.size)
-            self.mean_values.append(np.mean(self.original_points[self.cluster_ids == uid, :], axis=0))
-            self.covariances.append(np.cov(self.original_points[self.cluster_ids == uid, :]))
+        # compute GMM parameters, one row per cluster in the order of the sorted cluster ids
+        self.mixing_factors, self.mean_values, self.covariances = cluster_statistics(original_points, cluster_ids,
+                                                                                     angle_column, weights)
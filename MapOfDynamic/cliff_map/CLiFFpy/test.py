@@ -1,6 +1,30 @@
+import os
+import tempfile
+import threading
 import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
 import cl_point
 import cl_arithmetic
+import cl_build
+import cl_delta
+import cl_eval
+import cl_ingest
+import cl_map
+import cl_map_visualisation
+import cl_mod
+import flow_net
+import helpers
+import mean_shift
+
+
+def atc_rows(rng, n, time=None):
+    # n synthetic rows in the raw ATC format (mm, mm/s), one every 0.1 s unless time is given
+    return pd.DataFrame({'time': np.arange(n) * 0.1 if time is None else time,
+                         'person_id': rng.integers(0, 20, n), 'x': rng.uniform(-3000, 3000, n),
+                         'y': rng.uniform(-2000, 2000, n), 'z': 0., 'velocity': rng.normal(1200, 200, n),
+                         'motion_angle': rng.normal(1., 0.3, n), 'facing_angle': 0.})
 
 
 class TestDistanceMetrics(unittest.TestCase):
@@ -42,6 +66,530 @@ class TestDistanceMetrics(unittest.TestCase):
             self.assertAlmostEqual(cl_arithmetic.distance_wrap_2d(self.test_p1[i], self.test_p2[i]), self.test_d_wrap[i],
                                    self.places)
 
+    def test_wrap_to_pi_vec(self):
+        a = np.linspace(-20, 20, 1001)
+        expected = [cl_arithmetic.wrap_to_pi(x) for x in a]
+        np.testing.assert_allclose(cl_arithmetic.wrap_to_pi_vec(a), expected)
+        cl_arithmetic.wrap_to_pi_vec(a, out=a)
+        np.testing.assert_allclose(a, expected)
+
+    def test_distance_wrap_2d_vec_pair(self):
+        rng = np.random.default_rng(0)
+        p1 = rng.uniform(-5, 5, (70, 2))
+        p2 = rng.uniform(-5, 5, (40, 2))
+        dist = cl_arithmetic.distance_wrap_2d_vec_pair(p1, p2, block_size=16)
+        self.assertEqual(dist.shape, (40, 70))
+        for j in range(len(p2)):
+            np.testing.assert_array_equal(dist[j], cl_arithmetic.distance_wrap_2d_vec(p1, p2[j]))
+        dist_32 = cl_arithmetic.distance_wrap_2d_vec_pair(p1, p2, dtype=np.float32)
+        self.assertEqual(dist_32.dtype, np.float32)
+        np.testing.assert_allclose(dist_32, dist, rtol=1e-5)
+
+    def test_weighted_mean_2d_pair(self):
+        rng = np.random.default_rng(0)
+        p = rng.uniform(0, 6, (50, 2))
+        w = cl_arithmetic.gaussian_weights_pair(p, p[:10], 0.5)
+        means = cl_arithmetic.weighted_mean_2d_pair(p, w)
+        for k in range(len(w)):
+            np.testing.assert_allclose(means[k], cl_arithmetic.weighted_mean_2d_vec(p, w[k]))
+
+
+class TestMeanShift(unittest.TestCase):
+    def test_cluster_statistics(self):
+        points = np.array([[1., np.pi - 0.1], [2., -np.pi + 0.1], [1.5, 0.3], [5., 1.]])
+        weights, means, covariances = mean_shift.cluster_statistics(points, np.array([4, 4, 0, 4]), angle_column=1)
+        np.testing.assert_allclose(weights, [0.25, 0.75])
+        # the circular mean of the angles of cluster 4 lies near pi, not at their arithmetic mean
+        np.testing.assert_allclose(means, [[1.5, 0.3], [8. / 3., np.arctan2(np.sin(1.), np.cos(1.) - 2 * np.cos(0.1))]])
+        np.testing.assert_array_equal(covariances[0], np.zeros((2, 2)))
+        deviations = np.array([[1., np.pi - 0.1], [2., -np.pi + 0.1], [5., 1.]]) - means[1]
+        deviations[:, 1] = cl_arithmetic.wrap_to_pi_vec(deviations[:, 1])
+        np.testing.assert_allclose(covariances[1], deviations.T @ deviations / 2)
+
+
+class TestCLMap(unittest.TestCase):
+    def setUp(self):
+        self.map = cl_map.CLMap(pool_num=1)
+        self.map.set_up_map(step=1., radius=0.8, type=cl_map.CLCellShape.CIRCULAR)
+        self.points = np.random.default_rng(0).uniform(-3, 3, (500, 2))
+
+    def test_circular_cell_members(self):
+        corners, members = self.map.get_cell_members(self.points)
+        self.assertEqual(len(corners), len(members))
+        for corner, indices in zip(corners, members):
+            center = np.array(corner) + self.map.grid_step / 2
+            inside = np.flatnonzero(np.linalg.norm(self.points - center, axis=1) <= self.map.grid_radius)
+            np.testing.assert_array_equal(indices, inside)
+        # overlapping circles cover every point at least once
+        self.assertEqual(np.unique(np.concatenate(members)).size, len(self.points))
+
+    def test_batch_loads_index_kept_rows(self):
+        batch_map = cl_map.CLMap(pool_num=1)
+        batch_map.set_up_map(step=1.)
+        rng = np.random.default_rng(1)
+        for n in (200, 300):
+            batch_map.load_data(atc_rows(rng, n, time=0.))
+        self.assertEqual(len(batch_map.data), 500)
+        self.assertEqual(sum(cell.length for cell in batch_map.cells_data), 500)
+        for cell in batch_map.cells_data:
+            rows = batch_map.data.iloc[batch_map.cell_index[cell.offset:cell.offset + cell.length]]
+            np.testing.assert_array_equal(rows[['velocity', 'motion_angle']].to_numpy(), cell.points)
+            # with step 1 the corner of a square cell is the rounded position of its points
+            np.testing.assert_array_equal(np.round(rows[['x', 'y']].to_numpy()),
+                                          np.tile(np.array(cell.corner), (len(rows), 1)))
+
+    def test_stream_decay_eviction(self):
+        def frame(time, x):
+            return pd.DataFrame({'time': [time] * 4, 'person_id': 1, 'x': [x] * 4, 'y': 0., 'z': 0.,
+                                 'velocity': [1000., 1000., 1500., 1500.], 'motion_angle': 1., 'facing_angle': 0.})
+
+        stream_map = cl_map.CLMap(pool_num=1)
+        stream_map.set_up_map(step=1., processing=cl_map.CLCellType.STREAM, half_life=10., min_weight=0.5)
+        stream_map.load_data(frame(0., 0.))
+        stream_map.load_data(frame(10., 5000.))
+        self.assertEqual(len(stream_map.cells_data), 2)
+        cell = stream_map.cells_data[0]
+        np.testing.assert_allclose(cell.count, [1., 1.])
+        np.testing.assert_allclose(np.array(cell.sums) / np.array(cell.count)[:, None], [[1., 1.], [1.5, 1.]])
+        # after five more half lives the first cell falls below min_weight and is evicted
+        stream_map.load_data(frame(60., 5000.))
+        self.assertEqual([cell.corner for cell in stream_map.cells_data], [(5., 0.)])
+
+    def test_stream_decay_weights_clustering(self):
+        def frame(time, n, angle):
+            return pd.DataFrame({'time': [time] * n, 'person_id': 1, 'x': 0., 'y': 0., 'z': 0., 'velocity': 1000.,
+                                 'motion_angle': angle, 'facing_angle': 0.})
+
+        for half_life, new_share in ((None, 0.25), (10., 10. / 13.75)):
+            stream_map = cl_map.CLMap(pool_num=1)
+            stream_map.set_up_map(step=1., processing=cl_map.CLCellType.STREAM, half_life=half_life)
+            # an old flow of 30 observations, then three half lives later a new flow of 10
+            stream_map.load_data(frame(0., 30, 1.))
+            stream_map.load_data(frame(30., 10, -2.))
+            stream_map.cluster_data()
+            result = stream_map.cells_data[0].clustering_results
+            self.assertAlmostEqual(result.mixing_factors[np.argmin(result.mean_values[:, 1])], new_share)
+
+    def test_stream_change_tracking(self):
+        def frame(time, x):
+            return pd.DataFrame({'time': [time] * 4, 'person_id': 1, 'x': [x] * 4, 'y': 0., 'z': 0.,
+                                 'velocity': [1000., 1000., 1500., 1500.], 'motion_angle': 1., 'facing_angle': 0.})
+
+        def refresh():
+            stream_map.cluster_data(only_changed=True)
+            changed, removed = stream_map.pop_changes()
+            return [cell.corner for cell in changed], removed
+
+        stream_map = cl_map.CLMap(pool_num=1)
+        stream_map.set_up_map(step=1., processing=cl_map.CLCellType.STREAM, half_life=10., min_weight=0.5)
+        stream_map.load_data(pd.concat([frame(0., 0.), frame(0., 5000.)]))
+        self.assertEqual(refresh(), ([(0., 0.), (5., 0.)], []))
+        # nothing was loaded since, so nothing is clustered or exported
+        self.assertEqual(refresh(), ([], []))
+        stream_map.load_data(frame(10., 5000.))
+        self.assertEqual(refresh(), ([(5., 0.)], []))
+        # the cell at the origin decays below min_weight and is evicted
+        stream_map.load_data(frame(60., 5000.))
+        self.assertEqual(refresh(), ([(5., 0.)], [(0., 0.)]))
+        # a cell whose clustering fails is exported without its previous results
+        stream_map.load_data(frame(61., 5000.))
+        with mock.patch.object(mean_shift.MeanShift, 'cluster', side_effect=ValueError("no clusters")):
+            changed, removed = refresh()
+        self.assertEqual(changed, [(5., 0.)])
+        self.assertIsNone(stream_map.cells_data[0].clustering_results)
+        self.assertEqual(len(cl_delta.cell_records(stream_map.cells_data[0])), 0)
+
+    def test_checkpoint_resume(self):
+        rng = np.random.default_rng(0)
+        n = 3000
+        rows = atc_rows(rng, n)
+        folder = tempfile.mkdtemp()
+        file_name = os.path.join(folder, "atc.csv")
+        rows.to_csv(file_name, header=False, index=False)
+        checkpoint = os.path.join(folder, "checkpoint.npz")
+
+        def new_map(half_life):
+            stream_map = cl_map.CLMap(pool_num=1)
+            stream_map.set_up_map(step=1., processing=cl_map.CLCellType.STREAM, half_life=half_life, min_weight=0.5)
+            return stream_map
+
+        for half_life in (None, 20.):
+            uninterrupted = new_map(half_life)
+            for chunk in cl_ingest.CSVChunkReader(file_name, chunksize=500):
+                uninterrupted.load_data(chunk)
+            # stop after three chunks, then resume from the checkpoint in a fresh map
+            interrupted = new_map(half_life)
+            reader = cl_ingest.CSVChunkReader(file_name, chunksize=500)
+            for i, chunk in enumerate(reader):
+                interrupted.load_data(chunk)
+                if i == 2:
+                    interrupted.save_checkpoint(checkpoint, reader.rows_read, loop_number=3)
+                    break
+            resumed = new_map(half_life)
+            cursor, meta = resumed.load_checkpoint(checkpoint)
+            self.assertEqual((cursor, meta), (1500, {'loop_number': 3}))
+            for chunk in cl_ingest.CSVChunkReader(file_name, chunksize=500, skiprows=cursor):
+                resumed.load_data(chunk)
+            self.assertEqual(resumed.last_time, uninterrupted.last_time)
+            self.assertEqual(resumed.data_extent, uninterrupted.data_extent)
+            self.assertEqual([cell.corner for cell in resumed.cells_data],
+                             [cell.corner for cell in uninterrupted.cells_data])
+            for cell, expected in zip(resumed.cells_data, uninterrupted.cells_data):
+                self.assertEqual(cell.corners, expected.corners)
+                np.testing.assert_allclose(cell.count, expected.count)
+                np.testing.assert_allclose(np.array(cell.sums), np.array(expected.sums))
+
+
+class TestCLBuild(unittest.TestCase):
+    def test_out_of_core_matches_batch(self):
+        rng = np.random.default_rng(3)
+        folder = tempfile.mkdtemp()
+        file_names = []
+        for i in range(2):
+            n = 400
+            rows = atc_rows(rng, n, time=1000. * i + np.repeat(np.arange(n // 4), 4) * 0.1)
+            file_names.append(os.path.join(folder, "atc-%d.csv" % i))
+            rows.to_csv(file_names[-1], header=False, index=False)
+        spill_dir = os.path.join(folder, "spill")
+        for shape, keep_spill in ((cl_map.CLCellShape.SQUARE, False), (cl_map.CLCellShape.CIRCULAR, True)):
+            out_of_core = cl_build.build_out_of_core(file_names, spill_dir, partitions=5, pool_num=2, chunksize=150,
+                                                     keep_spill=keep_spill, step=2., radius=1.5, type=shape)
+            if keep_spill:
+                self.assertEqual(len(os.listdir(spill_dir)), 5)
+            else:
+                self.assertFalse(os.path.exists(spill_dir))
+            batch = cl_map.CLMap(pool_num=1)
+            batch.set_up_map(step=2., radius=1.5, type=shape)
+            batch.load_data(pd.concat([pd.read_csv(f, header=None, names=cl_ingest.ATC_HEADER) for f in file_names],
+                                      ignore_index=True))
+            batch.cluster_data()
+            self.assertEqual(out_of_core.total_number_of_observations, batch.total_number_of_observations)
+            self.assertEqual(out_of_core.data_extent, batch.data_extent)
+            self.assertEqual([cell.corner for cell in out_of_core.cells_data],
+                             [cell.corner for cell in batch.cells_data])
+            for cell, expected in zip(out_of_core.cells_data, batch.cells_data):
+                self.assertEqual(cell.length, expected.length)
+                for field in ('mixing_factors', 'mean_values', 'covariances'):
+                    np.testing.assert_array_equal(getattr(cell.clustering_results, field),
+                                                  getattr(expected.clustering_results, field))
+
+    def test_build_map_matches_stream(self):
+        def micro_cells(built):
+            return {(cell.corner, tuple(corner)): (tuple(s), c) for cell in built.cells_data
+                    for corner, s, c in zip(cell.corners, cell.sums, cell.count)}
+
+        rng = np.random.default_rng(5)
+        folder = tempfile.mkdtemp()
+        partial_dir = os.path.join(folder, "partials")
+        file_names = []
+        for i in range(3):
+            file_names.append(os.path.join(folder, "atc-%d.csv" % i))
+            atc_rows(rng, 500, time=1000. * i + np.arange(500) * 0.1).to_csv(file_names[-1], header=False,
+                                                                           index=False)
+        stream = cl_map.CLMap(pool_num=1)
+        stream.set_up_map(step=2., processing=cl_map.CLCellType.STREAM)
+        for i in range(3):
+            stream.load_data(pd.read_csv(file_names[i], header=None, names=cl_ingest.ATC_HEADER))
+            if i == 0:
+                continue
+            built = cl_build.build_map(file_names[:i + 1], partial_dir, pool_num=2, chunksize=120, step=2.)
+            # load_data counts the time stamps of the last chunk only, build_map those of every file
+            self.assertEqual(built.total_number_of_observations, 500 * (i + 1))
+            self.assertEqual(built.data_extent, stream.data_extent)
+            expected = micro_cells(stream)
+            actual = micro_cells(built)
+            self.assertEqual(set(actual), set(expected))
+            for key, (sums, count) in actual.items():
+                self.assertEqual(count, expected[key][1])
+                np.testing.assert_allclose(sums, expected[key][0])
+            # the partials of the files already seen are reused, only the new file is computed
+            self.assertEqual(len(os.listdir(partial_dir)), i + 1)
+            if i == 1:
+                first_partials = {name: os.stat(os.path.join(partial_dir, name)).st_mtime_ns
+                                  for name in os.listdir(partial_dir)}
+        self.assertTrue(all(os.stat(os.path.join(partial_dir, name)).st_mtime_ns == mtime
+                            for name, mtime in first_partials.items()))
+
+
+class TestFlowNet(unittest.TestCase):
+    def test_auto_labeling_start_goal_region(self):
+        rng = np.random.default_rng(4)
+        # two dense areas, in mm, touching diagonally through one cell, and sparse noise around them
+        dense = np.concatenate([rng.uniform([0, 0], [2000, 2000], (300, 2)),
+                                rng.uniform([2000, 2000], [4000, 4000], (300, 2)),
+                                rng.uniform([10000, 0], [12000, 2000], (300, 2))])
+        noise = np.array([[20000., 20000.], [-8000., 5000.], [5000., -9000.], [30000., -9000.]])
+        points = np.concatenate([dense, noise])
+        order = rng.permutation(len(points))
+        start_goal_data = np.zeros((len(points) // 2, 7))
+        start_goal_data[:, 2:4] = points[order[:len(points) // 2]]
+        start_goal_data[:, 5:7] = points[order[len(points) // 2:]]
+        labels, regions = flow_net.grid_density_clustering(points / 1000., cell_size=1., min_count=4, min_points=40)
+        labelled, auto_regions = flow_net.auto_labeling_start_goal_region(start_goal_data, cell_size=1.,
+                                                                          min_count=4, min_points=40)
+        self.assertEqual(len(regions), 2)
+        self.assertEqual(auto_regions, regions)
+        np.testing.assert_array_equal(labels[900:], -1)
+        self.assertEqual(len(np.unique(labels[:600])), 1)
+        self.assertNotEqual(labels[0], labels[600])
+        # the labels written are the clustering labels of the starts and of the ends
+        np.testing.assert_array_equal(labelled[:, 7], labels[order[:len(points) // 2]])
+        np.testing.assert_array_equal(labelled[:, 8], labels[order[len(points) // 2:]])
+        np.testing.assert_array_equal(regions[1], [10., 0., 2., 2.])
+        # starts and ends are clustered on the grid by default, separately
+        start_pos, end_pos, start_labels, end_labels = flow_net.clustering_start_goal(start_goal_data, cell_size=1.)
+        np.testing.assert_array_equal(start_labels, flow_net.grid_density_clustering(start_pos, cell_size=1.)[0])
+        np.testing.assert_array_equal(end_labels, flow_net.grid_density_clustering(end_pos, cell_size=1.)[0])
+        labels, regions = flow_net.grid_density_clustering(np.empty((0, 2)))
+        self.assertEqual((len(labels), regions), (0, []))
+
+
+class TestCSVChunkReader(unittest.TestCase):
+    def test_filtered_chunks(self):
+        rng = np.random.default_rng(2)
+        n = 3000
+        rows = atc_rows(rng, n)
+        file_name = os.path.join(tempfile.mkdtemp(), "atc.csv")
+        rows.to_csv(file_name, header=False, index=False)
+        expected = rows.loc[rows['person_id'].isin([1, 2, 3])].copy()
+        for column in ('x', 'y', 'z', 'velocity'):
+            expected[column] = expected[column] / 1000.
+        expected = expected.loc[(expected['x'] >= -1.) & (expected['x'] < 2.) &
+                                (expected['y'] >= -1.) & (expected['y'] < 1.5)]
+        for use_process in (False, True):
+            reader = cl_ingest.CSVChunkReader(file_name, chunksize=700, units=1000., person_ids=[1, 2, 3],
+                                              bbox=(-1., 2., -1., 1.5), use_process=use_process)
+            # iterating again starts over, rows_read is a cursor into the file for every pass
+            for _ in range(2):
+                chunks = list(reader)
+                self.assertEqual(reader.rows_read, n)
+                pd.testing.assert_frame_equal(pd.concat(chunks), expected, check_dtype=False)
+
+    def test_dead_producer(self):
+        file_name = os.path.join(tempfile.mkdtemp(), "atc.csv")
+        atc_rows(np.random.default_rng(3), 3000).to_csv(file_name, header=False, index=False)
+        reader = cl_ingest.CSVChunkReader(file_name, chunksize=100, use_process=True)
+        reader.poll_interval = 0.1
+        chunks = iter(reader)
+        next(chunks)
+        reader.worker.terminate()
+        # the chunks queued before the producer died are still handed out, then the reader gives up
+        with self.assertRaises(RuntimeError):
+            for _ in chunks:
+                pass
+
+
+def one_cell_mod():
+    # one cell at the origin with two components over (speed, motion angle)
+    return cl_mod.CLMoD(1., 0., 0., [(0., 0.)], [10.], [[0.75, 0.25]],
+                        [[[1.2, 0.], [0.8, 3.]]], [[[[0.04, 0.], [0., 0.1]], [[0.02, 0.], [0., 0.2]]]],
+                        min_variance=0.)
+
+
+def mixture_log_likelihood(mod, heading, speed):
+    # log p(speed, heading) under the mixture of the first cell of mod, one component at a time
+    p = 0.
+    for w, m, cov in zip(mod.weights[0], mod.means[0], mod.covariances[0]):
+        d = np.array([speed - m[0], cl_arithmetic.wrap_to_pi(heading - m[1])])
+        p += w * np.exp(-0.5 * d @ np.linalg.inv(cov) @ d) / (2 * np.pi * np.sqrt(np.linalg.det(cov)))
+    return np.log(p)
+
+
+class TestCLMapVisualisation(unittest.TestCase):
+    def test_density_image(self):
+        rng = np.random.default_rng(8)
+        x, y = rng.uniform(-4, 7, 5000), rng.uniform(-3, 5, 5000)
+        extent, resolution = (-2., 5.05, -1., 3.), 0.1
+        image = cl_map_visualisation.density_image(x, y, extent, resolution)
+        # the last row and column of pixels reach past the extent when it is not a multiple of resolution
+        edges_x = extent[0] + np.arange(image.shape[1] + 1) * resolution
+        edges_y = extent[2] + np.arange(image.shape[0] + 1) * resolution
+        self.assertEqual(image.shape, (40, 71))
+        np.testing.assert_array_equal(image, np.histogram2d(y, x, bins=(edges_y, edges_x))[0])
+
+    def test_mode_arrows(self):
+        batch_map = cl_map.CLMap(pool_num=1)
+        batch_map.set_up_map(step=2.)
+        batch_map.load_data(atc_rows(np.random.default_rng(9), 400))
+        batch_map.cluster_data()
+        expected = []
+        for cell in batch_map.cells_data:
+            for m in cell.clustering_results.mean_values:
+                u, v = helpers.pol2cart(m[0], m[1])
+                expected.append([cell.corner[0] + batch_map.grid_step / 2, cell.corner[1] + batch_map.grid_step / 2,
+                                 u, v])
+        arrows = cl_map_visualisation.mode_arrows(batch_map)
+        np.testing.assert_allclose(arrows[np.lexsort(arrows.T[::-1])],
+                                   np.array(expected)[np.lexsort(np.array(expected).T[::-1])])
+
+    def test_frame_writer(self):
+        rendering = threading.Event()
+        release = threading.Event()
+        rendered = []
+
+        def render_frame(path, **kwargs):
+            rendering.set()
+            release.wait()
+            rendered.append(path)
+
+        with mock.patch.object(cl_map_visualisation, 'render_frame', render_frame):
+            writer = cl_map_visualisation.FrameWriter(max_pending=2)
+            self.assertTrue(writer.write("0.png"))
+            rendering.wait()
+            # one frame is being drawn and two wait in the queue, the next ones are dropped
+            self.assertEqual([writer.write(str(i) + ".png") for i in range(1, 5)], [True, True, False, False])
+            self.assertEqual(writer.dropped, 2)
+            release.set()
+            writer.close()
+        self.assertEqual(rendered, ["0.png", "1.png", "2.png"])
+
+    def test_locations_need_kept_data(self):
+        batch_map = cl_map.CLMap(pool_num=1)
+        batch_map.set_up_map(step=2., keep_data=False)
+        batch_map.load_data(atc_rows(np.random.default_rng(10), 50))
+        with self.assertRaises(ValueError):
+            cl_map_visualisation.CLVisualisation(batch_map).show_raw_locations()
+
+
+class TestCLMoD(unittest.TestCase):
+    def setUp(self):
+        self.mod = one_cell_mod()
+        self.places = 6
+
+    def log_likelihood(self, heading, speed):
+        return mixture_log_likelihood(self.mod, heading, speed)
+
+    def test_score_trajectories(self):
+        trajectories = np.zeros((2, 4, 3))
+        trajectories[0, :3] = [[0., 0., 0.], [1., 0.3, 0.], [2., 0., -0.2]]
+        trajectories[1] = [[0., 5., 5.], [1., 5., 6.], [2., 0., 0.4], [2.5, 0., -0.1]]
+        total, steps, scored = self.mod.score_trajectories(trajectories, [3, 4])
+        self.assertAlmostEqual(steps[0, 0], self.log_likelihood(0., 0.3), self.places)
+        self.assertAlmostEqual(steps[0, 1], self.log_likelihood(np.arctan2(-0.2, -0.3), np.hypot(0.3, 0.2)),
+                               self.places)
+        self.assertAlmostEqual(steps[1, 2], self.log_likelihood(-np.pi / 2, 1.), self.places)
+        # padding is not scored, segments starting outside the map score the floor
+        self.assertTrue(np.isnan(steps[0, 2]))
+        np.testing.assert_array_equal(steps[1, :2], cl_mod.EMPTY_SCORE)
+        np.testing.assert_array_equal(scored, [2, 1])
+        np.testing.assert_allclose(total, [steps[0, 0] + steps[0, 1], 2 * cl_mod.EMPTY_SCORE + steps[1, 2]])
+        total, steps, scored = self.mod.score_trajectories(trajectories, [3, 4], empty_score=np.nan)
+        self.assertTrue(np.isnan(total[1]))
+
+    def test_sample(self):
+        x, y, heading, speed = (np.concatenate(c) for c in zip(*self.mod.sample(20000, chunk_size=6000, seed=1)))
+        self.assertEqual(len(x), 20000)
+        np.testing.assert_array_equal(self.mod.lookup(x, y), 0)
+        self.assertTrue(np.all((heading >= 0) & (heading <= 2 * np.pi)))
+        # the second component (heading 3, weight 0.25) is well separated from the first by heading
+        self.assertAlmostEqual(np.mean(np.abs(cl_arithmetic.wrap_to_pi_vec(heading - 3.)) < 1.5), 0.25, 1)
+        # the same seed and chunking reproduce the same samples
+        again = next(self.mod.sample(20000, chunk_size=6000, seed=1))
+        np.testing.assert_array_equal(again[3], speed[:6000])
+
+    def test_save_load(self):
+        path = os.path.join(tempfile.mkdtemp(), "mod.npz")
+        self.mod.save(path)
+        mod = cl_mod.CLMoD.load(path)
+        np.testing.assert_array_equal(mod.grid, self.mod.grid)
+        weights, means, covariances = mod.query(np.array([0.2, 3.]), np.array([-0.3, 0.]))
+        np.testing.assert_array_equal(weights, [self.mod.weights[0], [0., 0.]])
+        np.testing.assert_array_equal(covariances[0], self.mod.covariances[0])
+
+
+class TestCLDelta(unittest.TestCase):
+    def test_write_poll_compact(self):
+        folder = tempfile.mkdtemp()
+        log_path, snapshot_path = os.path.join(folder, "mod.log"), os.path.join(folder, "mod.csv")
+        writer = cl_delta.CLDeltaWriter(log_path, snapshot_path, compact_every=3)
+        a, b = np.arange(14.).reshape(2, 7), np.arange(7.).reshape(1, 7)
+        writer.write({(1, 2): a, (3, 4): b})
+        reader = cl_delta.CLDeltaReader(log_path, snapshot_path)
+        np.testing.assert_array_equal(reader.state[(1, 2)], a)
+        self.assertEqual(reader.seq, 1)
+        writer.write({(3, 4): a}, removed=[(1, 2)])
+        self.assertEqual(reader.poll(), {(1, 2), (3, 4)})
+        self.assertEqual(list(reader.state), [(3, 4)])
+        # the third delta compacts the log into the csv snapshot, readers notice and reload
+        writer.write({(5, 6): b})
+        self.assertEqual(os.path.getsize(log_path), cl_delta.RECORD_BYTES)
+        self.assertEqual(np.loadtxt(snapshot_path, delimiter=",", ndmin=2).shape, (3, 9))
+        reader.poll()
+        self.assertEqual(reader.seq, 3)
+        self.assertEqual(sorted(reader.state), [(3, 4), (5, 6)])
+        np.testing.assert_array_equal(reader.state[(3, 4)], a)
+        writer.close()
+
+    def test_reload_during_compaction(self):
+        folder = tempfile.mkdtemp()
+        log_path, snapshot_path = os.path.join(folder, "mod.log"), os.path.join(folder, "mod.csv")
+        writer = cl_delta.CLDeltaWriter(log_path, snapshot_path, compact_every=None)
+        records = np.arange(7.).reshape(1, 7)
+        writer.write({(0, 0): records})
+        writer.compact()
+        writer.write({(1, 1): records})
+        writer.write({(2, 2): records})
+        # the writer compacts right after the reader has read the old snapshot, before it reads the log
+        read_snapshot = cl_delta.read_snapshot
+
+        def racing_read_snapshot(path):
+            state = read_snapshot(path)
+            if not writer.log.closed and writer.seq == 3:
+                writer.write({(3, 3): records})
+                writer.compact()
+            return state
+
+        cl_delta.read_snapshot = racing_read_snapshot
+        try:
+            reader = cl_delta.CLDeltaReader(log_path, snapshot_path)
+        finally:
+            cl_delta.read_snapshot = read_snapshot
+        self.assertEqual(sorted(reader.state), [(0, 0), (1, 1), (2, 2), (3, 3)])
+        self.assertEqual(reader.seq, 4)
+        writer.close()
+
+
+class TestCLEval(unittest.TestCase):
+    def test_pareto_front(self):
+        results = [{'build_time': 1., 'log_likelihood': -2.}, {'build_time': 2., 'log_likelihood': -3.},
+                   {'build_time': 3., 'log_likelihood': -1.}, {'build_time': 1., 'log_likelihood': -2.5}]
+        front = cl_eval.pareto_front(results)
+        self.assertEqual([r['build_time'] for r in front], [1., 3.])
+
+    def test_split_observations(self):
+        data = atc_rows(np.random.default_rng(6), 1000)
+        train, test = cl_eval.split_observations(data, test_fraction=0.25)
+        self.assertEqual(len(train) + len(test), len(data))
+        self.assertFalse(set(train['person_id']) & set(test['person_id']))
+        self.assertEqual(test['person_id'].nunique(), round(data['person_id'].nunique() * 0.25))
+
+    def test_evaluate(self):
+        mod = one_cell_mod()
+        # raw rows in mm and mm/s, the last two fall outside the only cell
+        test = pd.DataFrame({'time': 0., 'person_id': 1, 'x': [100., -300., 5000., 0.], 'y': [-200., 0., 0., -4000.],
+                             'z': 0., 'velocity': [1200., 900., 1000., 1000.], 'motion_angle': [0.1, 2.9, 0., 0.],
+                             'facing_angle': 0.})
+        result = cl_eval.evaluate(mod, test)
+        self.assertAlmostEqual(result['log_likelihood'], (mixture_log_likelihood(mod, 0.1, 1.2) +
+                                                          mixture_log_likelihood(mod, 2.9, 0.9)) / 2)
+        self.assertEqual(result['empty_fraction'], 0.5)
+
+    def test_build_and_evaluate(self):
+        rng = np.random.default_rng(7)
+        train, test = atc_rows(rng, 300), atc_rows(rng, 100)
+        result = cl_eval.build_and_evaluate((train, test, {'step': 2.}))
+        reference = cl_map.CLMap(pool_num=1)
+        reference.set_up_map(step=2.)
+        reference.load_data(train.copy())
+        reference.cluster_data()
+        mod = reference.get_mod()
+        self.assertEqual(result['cells'], len(mod.corners))
+        self.assertEqual({k: result[k] for k in ('log_likelihood', 'empty_fraction')}, cl_eval.evaluate(mod, test))
+        # the sweep hands train and test to its workers once and gives the same results
+        results = cl_eval.sweep(train, test, {'step': [2., 3.]}, pool_num=2)
+        self.assertEqual([r['params'] for r in results], [{'step': 2.}, {'step': 3.}])
+        self.assertEqual(results[0]['log_likelihood'], result['log_likelihood'])
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
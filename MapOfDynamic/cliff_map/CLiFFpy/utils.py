@@ -1,4 +1,6 @@
 import math
+import os
+from contextlib import contextmanager
 
 import numpy as np
 
@@ -28,3 +30,20 @@ def cutoff(distances, treshold):
     closer = closer.astype(int)
     count = np.sum(closer, axis=1)
     return count
+
+
+@contextmanager
+def atomic_write(path):
+    # yields a binary file next to path that replaces path once the block completes, so readers and a
+    # restart after a crash only ever see the previous or the new complete file
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise